@@ -0,0 +1,23 @@
+"""
+Compare two benchmark files written with `st2022 --benchmark`.
+"""
+from sigtypst2022 import compare_benchmarks
+import argparse
+import sys
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compare ST 2022 Benchmarks')
+    parser.add_argument("old", help="Benchmark file of the earlier commit.")
+    parser.add_argument("new", help="Benchmark file of the later commit.")
+    parser.add_argument(
+            "--tolerance",
+            action="store",
+            type=float,
+            default=0.1,
+            help="Relative slowdown that is still accepted (default=0.1)."
+            )
+    args = parser.parse_args()
+    if compare_benchmarks(args.old, args.new, tolerance=args.tolerance):
+        sys.exit(1)
@@ -1,12 +1,12 @@
 """Utility functions and data handling for the shared task."""
 
 from lingpy import *
-from lingpy.evaluate.acd import _get_bcubed_score as bcubed_score
 from pathlib import Path
-from git import Repo
+from git import Repo, GitCommandError
 from lingpy.compare.partial import Partial
+from lingpy.algorithm import misc
 import argparse
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
 import random
 import networkx as nx
 from networkx.algorithms.clique import find_cliques
@@ -14,31 +14,272 @@ from lingpy.align.sca import get_consensus
 from lingpy.sequence.sound_classes import prosodic_string, class2tokens
 from lingpy.align.multiple import Multiple
 from lingrex.reconstruct import CorPaRClassifier, transform_alignment
-from lingrex.util import bleu_score
 from itertools import combinations
 from tabulate import tabulate
 import json
+import csv
 from tqdm import tqdm as progressbar
 import math
+import unicodedata
+import inspect
+import hashlib
+import pickle
+import numpy as np
+import os
+import shutil
+import tarfile
+import multiprocessing
+import time
+import tempfile
+import tracemalloc
+import platform
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    # shared memory is only available from Python 3.8 on
+    shared_memory = None
+from concurrent.futures import (
+        ProcessPoolExecutor, ThreadPoolExecutor, as_completed)
+from functools import partial
+from contextlib import contextmanager
+import cProfile
 
 
 def sigtypst2022_path(*comps):
     return Path(__file__).parent.parent.joinpath(*comps)
 
 
-def download(datasets, pth):
+class Profiler(object):
+    """
+    Count calls, wall time, items, and bytes read for stages of the pipeline.
+
+    Stages are only measured when the profiler is enabled. If a folder is
+    passed to `enable`, each stage is also run with cProfile, and the
+    statistics are written to this folder by `dump`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.label = ""
+        self.stats = OrderedDict()
+        self.profiles = {}
+        self.active = []
+
+    def enable(self, path=None):
+        self.enabled, self.path = True, path
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stats.clear()
+        self.profiles.clear()
+
+    def _record(self, name):
+        return self.stats.setdefault(
+                (self.label, name),
+                {"calls": 0, "seconds": 0.0, "items": 0, "bytes": 0})
+
+    def count(self, name, items=0, nbytes=0):
+        """
+        Add items and bytes to a stage without timing it.
+        """
+        if self.enabled:
+            record = self._record(name)
+            record["items"] += items
+            record["bytes"] += nbytes
+
+    @contextmanager
+    def stage(self, name, items=0, nbytes=0):
+        """
+        Measure the code in a with-statement as one call to a stage.
+
+        Stages nested in a stage of the same name are not counted again, and
+        cProfile only runs for the outermost stage.
+        """
+        if not self.enabled or name in self.active:
+            yield
+            return
+        profile = None
+        if self.path and not self.active:
+            profile = self.profiles.setdefault(
+                    (self.label, name), cProfile.Profile())
+            profile.enable()
+        self.active.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter()-start
+            self.active.pop()
+            if profile:
+                profile.disable()
+            record = self._record(name)
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["items"] += items
+            record["bytes"] += nbytes
+
+    def merge(self, stats):
+        """
+        Add the statistics collected by another profiler (e.g., in a worker).
+        """
+        for key, values in stats:
+            record = self.stats.setdefault(
+                    tuple(key), {name: 0 for name in values})
+            for name, value in values.items():
+                record[name] += value
+
+    def collect(self):
+        return [[list(key), dict(values)] for key, values in self.stats.items()]
+
+    def dump_profiles(self):
+        """
+        Write the cProfile statistics of each stage to a `.pstats` file in the
+        folder passed to `enable`.
+        """
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+        for (label, name), profile in self.profiles.items():
+            profile.dump_stats(Path(self.path).joinpath("{0}{1}.pstats".format(
+                label.replace(" / ", "-") + "-" if label else "", name)))
+
+    def dump(self):
+        """
+        Write the cProfile statistics and the statistics of all stages (to
+        the file `profile.json`) to the folder passed to `enable`.
+        """
+        self.dump_profiles()
+        with open(Path(self.path).joinpath("profile.json"), "w") as f:
+            json.dump(self.collect(), f, indent=2)
+
+    def report(self):
+        print(tabulate(
+            [list(key) + [
+                values["calls"], values["seconds"], values["items"],
+                values["bytes"] / 2**20] for key, values in sorted(
+                    self.stats.items())],
+            headers=["DATASET", "STAGE", "CALLS", "SECONDS", "ITEMS", "MB READ"],
+            floatfmt=".2f"))
+
+
+PROFILER = Profiler()
+
+
+class GitSource(object):
+    """
+    Source that clones the pinned version of a dataset from a GIT server.
+
+    :param url: The base URL, to which the path of the dataset is appended.
+    """
+
+    def __init__(self, url="https://github.com/"):
+        self.url = url
+
+    def clone(self, url, version, target):
+        try:
+            Repo.clone_from(url, target, depth=1, branch=version)
+        except GitCommandError:
+            # versions which are commits rather than tags need a full clone
+            if target.exists():
+                shutil.rmtree(target)
+            repo = Repo.clone_from(url, target)
+            repo.git.checkout(version)
+
+    def fetch(self, dataset, conditions, target):
+        self.clone(
+                self.url+conditions["path"]+".git", conditions["version"],
+                target)
+        return True
+
+
+class LocalSource(GitSource):
+    """
+    Source that resolves datasets from a folder with archives or bare repos.
+
+    Archives are named `DATASET-VERSION.tar.gz` or `DATASET.tar.gz` (also
+    with the suffix `.tgz` or `.tar`), and their content is extracted, with a
+    single top-level folder being removed. If the dataset has a `sha256` entry,
+    the checksum of the archive is verified before extracting it. Bare
+    repositories are named by the path of the dataset or by its identifier,
+    with the suffix `.git`.
+
+    :param path: The folder containing the archives and repositories.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def fetch(self, dataset, conditions, target):
+        for name in [dataset+"-"+conditions["version"], dataset]:
+            for suffix in [".tar.gz", ".tgz", ".tar"]:
+                archive = self.path.joinpath(name+suffix)
+                if archive.exists():
+                    self.extract(archive, conditions.get("sha256"), target)
+                    return True
+        for repo in [
+                self.path.joinpath(conditions["path"]+".git"),
+                self.path.joinpath(dataset+".git")]:
+            if repo.exists():
+                self.clone(
+                        repo.resolve().as_uri(), conditions["version"],
+                        target)
+                return True
+        return False
+
+    def extract(self, archive, sha256, target):
+        if sha256 and checksum(archive) != sha256:
+            raise ValueError("checksum of {0} does not match".format(archive))
+        tmp = target.parent.joinpath(target.name+".tmp")
+        with tarfile.open(archive) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(tmp, filter="data")
+            else:
+                tar.extractall(tmp)
+        content = list(tmp.iterdir())
+        if len(content) == 1 and content[0].is_dir():
+            content[0].rename(target)
+            tmp.rmdir()
+        else:
+            tmp.rename(target)
+
+
+def _fetch_dataset(dataset, conditions, pth, sources):
+    """
+    Fetch a dataset from the first source that provides it (pool task).
+    """
+    for source in sources:
+        if source.fetch(dataset, conditions, pth / dataset):
+            return dataset
+    raise ValueError("no source found for dataset {0}".format(dataset))
+
+
+def download(datasets, pth, jobs=1, mirror=None, sources=None):
     """
     Download all datasets as indicated with GIT.
+
+    :param jobs: The number of concurrent downloads.
+    :param mirror: A folder with archives or bare repositories (see
+        `LocalSource`), which is used before GitHub.
+    :param sources: The sources (like `GitSource` or `LocalSource`) from
+        which datasets are fetched, with the first one providing a dataset
+        being used.
     """
+    if sources is None:
+        sources = ([LocalSource(mirror)] if mirror else []) + [GitSource()]
+    pth.mkdir(parents=True, exist_ok=True)
+    tasks = []
     for dataset, conditions in datasets.items():
         if pth.joinpath(dataset, "cldf", "cldf-metadata.json").exists():
             print("[i] skipping existing dataset {0}".format(dataset))
         else:
-            repo = Repo.clone_from(
-                    "https://github.com/"+conditions["path"]+".git",
-                    pth / dataset)
-            repo.git.checkout(conditions["version"])
-            print("[i] downloaded {0}".format(dataset))
+            tasks += [(dataset, conditions)]
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = [
+                pool.submit(_fetch_dataset, dataset, conditions, pth, sources)
+                for dataset, conditions in tasks]
+        for future in as_completed(futures):
+            print("[i] downloaded {0}".format(future.result()))
 
 
 def get_cognates(wordlist, ref):
@@ -80,11 +321,158 @@ def get_cognates(wordlist, ref):
     return cognates
 
 
-def prepare(datasets, datapath, cldfdatapath, runs=1000):
+def _update_digest(digest, path):
+    """
+    Add the content of a file or of all files in a folder to a hash.
+    """
+    path = Path(path)
+    paths = sorted(p for p in path.rglob("*") if p.is_file()) if \
+            path.is_dir() else [path]
+    for p in paths:
+        if p != path:
+            digest.update(p.relative_to(path).as_posix().encode("utf-8"))
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                digest.update(chunk)
+    return digest
+
+
+def checksum(path):
+    """
+    Compute the SHA-256 checksum of a file or of all files in a folder.
+    """
+    return _update_digest(hashlib.sha256(), path).hexdigest()
+
+
+_SCORER_TASK = {}
+
+
+def _randist_task(runs, seed):
+    """
+    Compute the random distribution for a share of the runs (pool task).
+    """
+    random.seed(seed)
+    randist = _SCORER_TASK["part"]._get_partial_randist(
+            **dict(_SCORER_TASK["keywords"], runs=runs))
+    return {pair: dict(dist) for pair, dist in randist.items()}
+
+
+def get_partial_scorer(part, runs=1000, jobs=1):
+    """
+    Compute the LexStat scorer of a Partial object with parallel random runs.
+
+    The runs for the random distribution are split across worker processes,
+    each seeded from the global random state, and the resulting distributions
+    are averaged, weighted by the number of runs of each worker. Since Partial
+    objects cannot be pickled, workers are forked, and the computation is
+    carried out serially on platforms that do not support forking.
+    """
+    jobs = jobs or os.cpu_count()
+    if jobs == 1 or "fork" not in multiprocessing.get_all_start_methods():
+        part.get_partial_scorer(runs=runs)
+        return
+    chunks = [runs // jobs + (1 if i < runs % jobs else 0) for i in
+            range(jobs)]
+    chunks = [chunk for chunk in chunks if chunk]
+    seeds = [random.randrange(2**32) for chunk in chunks]
+    keywords = dict(part.get_partial_scorer(defaults=True), runs=runs)
+
+    # the attested distribution is needed to scale the random distribution
+    corrdist = part._get_partial_corrdist(**keywords)
+    _SCORER_TASK.update(part=part, keywords=keywords)
+    try:
+        # a pool of the fork context also works before Python 3.7, which
+        # lacks the mp_context argument of ProcessPoolExecutor
+        with multiprocessing.get_context("fork").Pool(len(chunks)) as pool:
+            randists = pool.starmap(_randist_task, zip(chunks, seeds))
+    finally:
+        _SCORER_TASK.clear()
+    randist = defaultdict(lambda : defaultdict(float))
+    for chunk, dists in zip(chunks, randists):
+        for pair, dist in dists.items():
+            for chars, value in dist.items():
+                randist[pair][chars] += value * chunk / sum(chunks)
+
+    # the scorer is assembled by LingPy from the precomputed distributions
+    part._get_partial_corrdist = lambda **keywords: corrdist
+    part._get_partial_randist = lambda **keywords: randist
+    try:
+        part.get_partial_scorer(runs=runs)
+    finally:
+        del part._get_partial_corrdist, part._get_partial_randist
+
+
+def get_cached_partial_scorer(part, path, runs=1000, jobs=1):
+    """
+    Load the LexStat scorer of a Partial object from file or compute it.
+
+    The scorer is stored as JSON along with a hash of the content of the
+    wordlist and the number of runs, and it is only reused if both are
+    unchanged.
+
+    :returns: True if the scorer was loaded from file.
+    """
+    key = hashlib.sha256(json.dumps(
+        [part.columns, [part[idx] for idx in sorted(part)], runs],
+        default=str).encode("utf-8")).hexdigest()
+    if path.exists():
+        with open(path) as f:
+            stored = json.load(f)
+        if stored["key"] == key:
+            part.cscorer = misc.ScoreDict(part.chars, stored["matrix"])
+            part._meta["scorer"]["cscorer"] = part.cscorer
+            # JSON has no tuples, which LingPy uses for some parameters
+            part.params = {"cscorer": {
+                k: tuple(v) if isinstance(v, list) else v for k, v in
+                stored["params"].items()}}
+            part._meta["params"] = part.params
+            return True
+    get_partial_scorer(part, runs=runs, jobs=jobs)
+    with open(path, "w") as f:
+        json.dump({
+            "key": key,
+            "matrix": [[float(x) for x in row] for row in
+                part.cscorer.matrix],
+            "params": part.params["cscorer"]}, f)
+    return False
+
+
+def prepare(
+        datasets, datapath, cldfdatapath, runs=1000, force=False, jobs=1,
+        threshold=0.45, cluster_method="infomap"):
     """
     Function computes cognates from a CLDF dataset and writes them to file.
+
+    Checksums of the CLDF data, the conditions, and the parameters of the
+    cognate detection are recorded in the file `manifest.json` in the
+    datapath, and datasets for which they have not changed are skipped,
+    unless `force` is set. The random runs of the cognate detection are
+    distributed over `jobs` processes, and the resulting scorer is stored in
+    the file `scorer.json` of each dataset, so that it is reused when only the
+    threshold or the cluster method change.
+
+    :returns: The datasets that were analyzed.
     """
+    manifest_path = datapath.joinpath("manifest.json")
+    manifest = {}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    analyzed = []
     for dataset, conditions in datasets.items():
+        entry = {
+                "checksum": checksum(cldfdatapath.joinpath(dataset, "cldf")),
+                "conditions": conditions,
+                "runs": None if conditions["cognates"] else runs,
+                "threshold": None if conditions["cognates"] else threshold,
+                "cluster_method": None if conditions["cognates"] else
+                    cluster_method
+                }
+        if not force and manifest.get(dataset) == entry and all(
+                datapath.joinpath(dataset, name).exists() for name in
+                ["cognates.tsv", "wordlist.tsv"]):
+            print("[i] skipping unchanged dataset {0}".format(dataset))
+            continue
         print("[i] analyzing {0}".format(dataset))
         columns = [
             "parameter_id",
@@ -111,11 +499,16 @@ def prepare(datasets, datapath, cldfdatapath, runs=1000):
         for idx, subgroup in wl.iter_rows("language_"+conditions["subgroup"]):
             if subgroup == conditions["name"]:
                 D[idx] = wl[idx]
+        if not datapath.joinpath(dataset).exists():
+            Path.mkdir(datapath.joinpath(dataset))
         if not conditions["cognates"]:
             part = Partial(D)
-            part.get_partial_scorer(runs=runs)
-            part.partial_cluster(method="lexstat", threshold=0.45, ref="cogids",
-                    cluster_method="infomap")
+            if get_cached_partial_scorer(
+                    part, datapath.joinpath(dataset, "scorer.json"),
+                    runs=runs, jobs=jobs):
+                print("[i] loaded scorer for {0}".format(dataset))
+            part.partial_cluster(method="lexstat", threshold=threshold,
+                    ref="cogids", cluster_method=cluster_method)
             ref = "cogids"
         elif conditions["cognates"] in ["cognacy", "partial_cognacy"]:
             part = Wordlist(D)
@@ -129,302 +522,1380 @@ def prepare(datasets, datapath, cldfdatapath, runs=1000):
             ref = "cogid"
         cognates = get_cognates(part, ref)
 
-        if datapath.joinpath(dataset).exists():
-            pass
-        else:
-            Path.mkdir(datapath.joinpath(dataset))
-        with open(datapath.joinpath(dataset, "cognates.tsv"), "w") as f:
-            f.write("COGID\t"+"\t".join(part.cols)+"\n")
-            for cogid, idxs in cognates.items():
-                f.write("{0}".format(cogid))
-                for language in part.cols:
-                    f.write("\t{0}".format(idxs[language]))
-                f.write("\n")
+        write_cognate_file(
+                part.cols, cognates, datapath.joinpath(dataset, "cognates.tsv"))
         part.output(
                 "tsv", filename=datapath.joinpath(dataset, "wordlist").as_posix(), ignore="all", prettify=False)
+        analyzed += [dataset]
 
+        # update the manifest after each dataset to resume interrupted runs
+        manifest[dataset] = entry
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    return analyzed
 
 
 
 
-def load_cognate_file(path):
+def _read_rows(path):
     """
-    Helper function for simplified cognate formats.
+    Yield the cells of a tab-separated file line by line.
+    """
+    with open(path, encoding="utf-8-sig") as f:
+        for line in f:
+            line = unicodedata.normalize("NFC", line.strip("\r\n"))
+            if line and not line.startswith("#"):
+                yield [cell.strip() for cell in line.split("\t")]
+
+
+def iter_cognate_file(path):
+    """
+    Iterate lazily over the cognate sets in a file in simplified format.
+
+    :returns: The languages in the file and a generator yielding pairs of
+        cognate set identifier and a dictionary of tokenized entries.
+    """
+    if _fresh_binary(path):
+        languages, data = read_cognate_binary(binary_path(path))
+        return languages, iter(data.items())
+    rows = _read_rows(path)
+    languages = next(rows)[1:]
+
+    def cognate_sets():
+        for row in rows:
+            yield row[0], {
+                    language: entry.split() for language, entry in zip(
+                        languages, row[1:])}
+    return languages, cognate_sets()
+
+
+def get_sound_index(languages, data):
+    """
+    Index the positions of each sound in each language.
     """
-    data = csv2list(path, strip_lines=False)
-    header = data[0]
-    languages = header[1:]
-    out = {}
     sounds = defaultdict(lambda : defaultdict(list))
-    for row in data[1:]:
-        out[row[0]] = {}
-        for language, entry in zip(languages, row[1:]):
-            out[row[0]][language] = entry.split()
-            for i, sound in enumerate(entry.split()):
-                sounds[sound][language] += [[row[0], i]]
-    return languages, sounds, out
+    for cogid, entries in data.items():
+        for language in languages:
+            for i, sound in enumerate(entries.get(language, [])):
+                sounds[sound][language] += [[cogid, i]]
+    return sounds
 
 
+def load_cognate_file(path, sounds=True):
+    """
+    Helper function for simplified cognate formats.
 
-def write_cognate_file(languages, data, path):
-    with open(path, "w") as f:
+    :param sounds: If set to False, the index of sounds is not computed and
+        None is returned instead.
+    """
+    with PROFILER.stage("load"):
+        if _fresh_binary(path):
+            languages, out = read_cognate_binary(binary_path(path))
+        else:
+            languages, cognate_sets = iter_cognate_file(path)
+            out = dict(cognate_sets)
+        if PROFILER.enabled:
+            PROFILER.count("load", len(out), _read_size(path))
+    if sounds:
+        return languages, get_sound_index(languages, out), out
+    return languages, None, out
+
+
+def _cell(entry):
+    """
+    Format an entry, given as list of tokens or as string, for a cell.
+    """
+    return entry if isinstance(entry, str) else " ".join(entry)
+
+
+def write_cognate_file(
+        languages, data, path, binary=False, buffering=2**20):
+    """
+    Write cognate sets to file in simplified format.
+
+    :param data: A dictionary of cognate sets, or an iterable (e.g., a
+        generator) of pairs of cognate set identifier and entries, with each
+        entry given as a list of tokens or as a string.
+    :param binary: If set to True, a binary copy of the data is written
+        alongside the file, from which `load_cognate_file` reads the data.
+    :param buffering: The size of the write buffer in bytes.
+    """
+    items = data.items() if isinstance(data, dict) else data
+    if binary:
+        items = list(items)
+    with open(path, "w", buffering=buffering) as f:
         f.write("COGID\t"+"\t".join(languages)+"\n")
-        for k, v in data.items():
-            f.write("{0}".format(k))
-            for language in languages:
-                f.write("\t"+" ".join(v.get(language, [])))
-            f.write("\n")
+        f.writelines(
+                "\t".join([str(k)]+[_cell(v.get(language, [])) for language
+                    in languages])+"\n" for k, v in items)
+    if binary:
+        write_cognate_binary(languages, dict(items), binary_path(path))
+    elif binary_path(path).exists():
+        binary_path(path).unlink()
+
+
+BINARY_MAGIC = b"ST2022C1"
+
+
+def binary_path(path):
+    """
+    Return the path of the binary copy of a cognate file.
+    """
+    return Path(path).with_suffix(".bin")
+
+
+def _fresh_binary(path):
+    """
+    Check if a binary copy of a cognate file exists and is up to date.
+    """
+    bpath, path = binary_path(path), Path(path)
+    if not bpath.exists():
+        return False
+    return not path.exists() or bpath.stat().st_mtime >= path.stat().st_mtime
+
+
+def _read_size(path):
+    """
+    Return the size of the file from which a cognate file is read.
+    """
+    if _fresh_binary(path):
+        return binary_path(path).stat().st_size
+    return Path(path).stat().st_size
 
 
+def write_cognate_binary(languages, data, path):
+    """
+    Write cognate sets to a binary columnar file.
+
+    The file starts with a JSON header containing the languages, the cognate
+    set identifiers, and the vocabulary of segments, followed by an array of
+    offsets and an array of segment codes, in which the cells of each
+    language are stored contiguously.
+    """
+    vocabulary = {}
+    cogids = [str(k) for k in data]
+    segments, offsets = [], [0]
+    for language in languages:
+        for v in data.values():
+            for segment in _cell(v.get(language, [])).split():
+                segments += [vocabulary.setdefault(segment, len(vocabulary))]
+            offsets += [len(segments)]
+    header = {
+            "languages": list(languages),
+            "cogids": cogids,
+            "vocabulary": list(vocabulary)}
+    header = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    header += b" " * (-(len(BINARY_MAGIC) + 8 + len(header)) % 8)
+    with open(path, "wb") as f:
+        f.write(BINARY_MAGIC)
+        f.write(np.array([len(header)], dtype="<u8").tobytes())
+        f.write(header)
+        f.write(np.array(offsets, dtype="<i8").tobytes())
+        f.write(np.array(segments, dtype="<i4").tobytes())
+
 
-def split_training_test_data(data, languages, ratio=0.1):
+def read_cognate_binary(path, languages=None):
+    """
+    Read cognate sets from a binary columnar file via memory-mapping.
+
+    :param languages: Restrict the data to these languages.
+    :returns: The languages and the cognate sets.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("{0} is not a binary cognate file".format(path))
+        size = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        header = json.loads(f.read(size).decode("utf-8"))
+    start = len(BINARY_MAGIC) + 8 + size
+    all_languages, cogids = header["languages"], header["cogids"]
+    vocabulary = np.array(header["vocabulary"], dtype=object)
+    offsets = np.memmap(
+            path, dtype="<i8", mode="r", offset=start,
+            shape=(len(all_languages)*len(cogids)+1,))
+    if offsets[-1]:
+        segments = vocabulary[np.memmap(
+                path, dtype="<i4", mode="r", offset=start+8*len(offsets),
+                shape=(int(offsets[-1]),))].tolist()
+    else:
+        segments = []
+    languages = languages or all_languages
+    data = {cogid: {} for cogid in cogids}
+    for language in languages:
+        first = all_languages.index(language) * len(cogids)
+        bounds = offsets[first:first+len(cogids)+1].tolist()
+        for cogid, i, j in zip(cogids, bounds[:-1], bounds[1:]):
+            data[cogid][language] = segments[i:j]
+    return languages, data
+
+
+def coverage_order(data):
+    """
+    Order cognate sets by the number of languages in which they are attested.
+
+    Sets with the same coverage keep their original order.
+    """
+    keys = list(data)
+    coverage = np.array(
+            [sum(1 for entry in data[key].values() if entry and entry != ["?"])
+                for key in keys], dtype=np.int32)
+    return [keys[i] for i in np.argsort(-coverage, kind="stable")]
+
+
+def split_training_test_data(data, languages, ratio=0.1, order=None):
     """
     Split data into test and training data.
+
+    Cognate sets are ordered by their coverage (see `coverage_order`, whose
+    result can be passed as `order` when splitting the same data repeatedly),
+    and the best-covered sets are retained for testing. Test items share the
+    word lists of the data.
     """
     split_off = int(len(data) * ratio + 0.5)
-    cognates = [key for key, value in sorted(
-        data.items(),
-        key=lambda x: sum([1 if " ".join(b) not in ["", "?"] else 0 for a, b in
-            x[1].items()]),
-        reverse=True)
-        ]
+    cognates = order or coverage_order(data)
     test_, training = (
             {c: data[c] for c in cognates[:split_off]}, 
             {c: data[c] for c in cognates[split_off:]}
             )
     
     # now, create new items for all languages to be predicted
-    test = defaultdict(dict)
-    solutions = defaultdict(dict)
+    test, solutions = {}, {}
     for i, language in enumerate(languages):
         for key, values in test_.items():
-            if " ".join(test_[key][language]):
+            if values[language]:
                 new_key = key+"-"+str(i+1)
-                for j, languageB in enumerate(languages):
-                    if language != languageB:
-                        test[new_key][languageB] = test_[key][languageB]
-                    else:
-                        test[new_key][language] = ["?"]
-                        solutions[new_key][language] = test_[key][language]
+                test[new_key] = dict(values)
+                test[new_key][language] = ["?"]
+                solutions[new_key] = {language: values[language]}
     
     return training, test, solutions
     
 
-def split_data(datasets, pth, props=None):
-    props = props or [0.1, 0.2, 0.3, 0.4, 0.5]
-
+def _split_task(dataset, pth, props, binary=False):
+    """
+    Split one dataset for all proportions (used as a pool task).
+    """
+    languages, sounds, data = load_cognate_file(
+            pth.joinpath(dataset, "cognates.tsv"), sounds=False)
+    order = coverage_order(data)
     for prop in props:
-        for dataset, conditions in datasets.items():
-            languages, sounds, data = load_cognate_file(
-                    pth.joinpath(dataset, "cognates.tsv"))
-            #data_part, solutions = split_training(data, ratio=prop)
-            training, test, solutions = split_training_test_data(
-                    data, languages, ratio=prop)
-            write_cognate_file(
-                    languages, 
-                    training,
-                    pth.joinpath(
-                        dataset, "training-{0:.2f}.tsv".format(prop)),
-                    )
-            write_cognate_file(
-                    languages, 
-                    test,
-                    pth.joinpath(
-                        dataset, "test-{0:.2f}.tsv".format(prop)),
-                    )
+        training, test, solutions = split_training_test_data(
+                data, languages, ratio=prop, order=order)
+        for name, part in [
+                ("training", training), ("test", test),
+                ("solutions", solutions)]:
             write_cognate_file(
                     languages,
-                    solutions,
+                    part,
                     pth.joinpath(
-                        dataset, "solutions-{0:.2f}.tsv".format(prop)),
+                        dataset, "{0}-{1:.2f}.tsv".format(name, prop)),
+                    binary=binary
                     )
-            print("[i] wrote training and solution data for {0} / {1:.2f}".format(
-                dataset, prop))
+        print("[i] wrote training and solution data for {0} / {1:.2f}".format(
+            dataset, prop))
+    return dataset
+
+
+def split_data(datasets, pth, props=None, binary=False, jobs=1):
+    """
+    Split all datasets into training and test data for all proportions.
+
+    Each dataset is loaded and ordered once for all proportions, and the
+    datasets are distributed over `jobs` processes.
+    """
+    props = props or [0.1, 0.2, 0.3, 0.4, 0.5]
+    jobs = jobs or os.cpu_count()
+    if jobs == 1:
+        for dataset in datasets:
+            _split_task(dataset, pth, props, binary)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for future in as_completed([
+                    pool.submit(_split_task, dataset, pth, props, binary)
+                    for dataset in datasets]):
+                future.result()
+
+
+
+def _merge_columns(alignment, merges):
+    """
+    Merge the cells of the columns marked in `merges` into the preceding
+    cells, in one pass over each row.
+    """
+    if not merges.any():
+        return alignment
+    # leading merge columns are kept, and no column is merged then
+    if merges[0]:
+        return [[cell or "-" for cell in row] for row in alignment]
+    # each column that is not merged starts a span of cells
+    starts = np.flatnonzero(~merges).tolist()
+    spans = [
+            (k, start, end) for k, (start, end) in enumerate(
+                zip(starts, starts[1:]+[len(merges)])) if end-start > 1]
+    new_alms = []
+    for row in alignment:
+        new_alm = [row[start] for start in starts]
+        for k, start, end in spans:
+            cell = new_alm[k]
+            for other in row[start+1:end]:
+                if other != "-":
+                    cell += "."+other if cell else other
+            new_alm[k] = cell
+        if "" in new_alm:
+            new_alm = [cell or "-" for cell in new_alm]
+        new_alms += [new_alm]
+    return new_alms
+
+
+def ungap(alignment, languages, proto):
+    """
+    Merge columns in which all languages apart from the proto-language
+    have gaps into the preceding column.
+    """
+    others = [
+            j >= len(languages) or languages[j] != proto for j in
+            range(len(alignment))]
+    if not any(others):
+        return alignment
+    matrix = np.array(alignment, dtype=object)[others]
+    return _merge_columns(alignment, (matrix == "-").all(axis=0))
+
+
+def ungap_batch(items):
+    """
+    Ungap many alignments at once.
+
+    The cells of all columns are collected in one array, without the cells
+    of the proto-languages, so that the columns to merge are found with one
+    comparison and one reduction.
+
+    :param items: Triples of alignment, languages, and proto-language.
+    :returns: The ungapped alignments, in the order of the items.
+    """
+    cells, starts, empty = [], [], []
+    for alignment, languages, proto in items:
+        rows = [row for j, row in enumerate(alignment) if
+                j >= len(languages) or languages[j] != proto]
+        for column in zip(*rows) if rows else alignment[0]:
+            starts += [len(cells)]
+            empty += [not rows]
+            if rows:
+                cells += column
+    if not starts:
+        return []
+    # the sentinel keeps the starts of empty columns within the array
+    gaps = np.array(cells+["-"], dtype=object) == "-"
+    merges = np.logical_and.reduceat(gaps, starts) & ~np.array(empty)
+    out, offset = [], 0
+    for alignment, languages, proto in items:
+        out += [_merge_columns(
+            alignment, merges[offset:offset+len(alignment[0])])]
+        offset += len(alignment[0])
+    return out
+
+
+class AlignmentCache(object):
+    """
+    Bounded cache of multiple alignments of cognate sets.
+
+    The sequences are aligned in a canonical order, so that the same
+    alignment can be reused for each target language of a cognate set.
+    The alignments are not pickled, so that models and worker processes
+    start with an empty cache.
+
+    :param maxsize: The maximal number of alignments kept in the cache.
+    """
+
+    def __init__(self, maxsize=2**16):
+        self.maxsize = maxsize
+        self.alignments = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __repr__(self):
+        return "AlignmentCache(maxsize={0})".format(self.maxsize)
+
+    def __getstate__(self):
+        return {"maxsize": self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def clear(self):
+        self.alignments.clear()
+        self.hits, self.misses = 0, 0
+
+    def align(self, seqs, gap="-"):
+        """
+        Return the aligned sequences in the order in which they were passed.
+        """
+        seqs = [tuple(s for s in seq if s != gap) for seq in seqs]
+        key = tuple(sorted(seqs))
+        if key in self.alignments:
+            self.alignments.move_to_end(key)
+            self.hits += 1
+        else:
+            msa = Multiple([list(seq) for seq in key])
+            msa.prog_align()
+            self.alignments[key] = [tuple(alm) for alm in msa.alm_matrix]
+            if len(self.alignments) > self.maxsize:
+                self.alignments.popitem(last=False)
+            self.misses += 1
+        rows = defaultdict(list)
+        for seq, alm in zip(key, self.alignments[key]):
+            rows[seq] += [alm]
+        used = defaultdict(int)
+        out = []
+        for seq in seqs:
+            out += [list(rows[seq][used[seq]])]
+            used[seq] += 1
+        return out
+
+
+ALIGNMENT_CACHE = AlignmentCache()
+
+
+def simple_align(
+        seqs, 
+        languages, 
+        all_languages,
+        align=True,
+        training=True,
+        missing="Ø", 
+        gap="-",
+        cache=None,
+        ):
+    """
+    Simple alignment function that inserts entries for missing data.
+
+    If an `AlignmentCache` is passed (e.g., `ALIGNMENT_CACHE`), multiple
+    alignments are memoized. Since the cache aligns the sequences in a
+    canonical order, and progressive alignment depends on the order, the
+    predictions may differ from those of the reference baseline, which is
+    why the cache is not used by default.
+    """
+    if align and cache is not None:
+        seqs, align = cache.align(seqs, gap=gap), False
+    return transform_alignment(
+            seqs, languages, all_languages, align=align,
+            training=training, missing=missing, gap=gap, startend=False,
+            prosody=False, position=False, firstlast=False)
+
+
+def fit_classifier(clf, matrix, solutions, weights=None):
+    """
+    Fit a classifier on unique patterns, passing their counts as weights.
+
+    Classifiers whose `fit` method does not accept `sample_weight` (like the
+    `CorPaRClassifier`) are fitted on the unique patterns alone, which does
+    not change their results, since they only consider distinct patterns.
+    For other classifiers, like SVMs, weights are not the same as repeated
+    samples, so they should be fitted on all rows instead.
+    """
+    if weights is not None and "sample_weight" in inspect.signature(
+            clf.fit).parameters:
+        return clf.fit(matrix, solutions, sample_weight=weights)
+    return clf.fit(matrix, solutions)
+
+
+def share_arrays(arrays):
+    """
+    Copy arrays into one block of shared memory.
+
+    :returns: The shared memory and, for each array, its offset, shape, and
+        data type, from which workers can attach to it with `attach_arrays`.
+    """
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    specs, offset = [], 0
+    for array in arrays:
+        specs += [(offset, array.shape, array.dtype.str)]
+        # keep all arrays aligned to eight bytes
+        offset += -(-array.nbytes // 8) * 8
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for array, (offset, shape, dtype) in zip(arrays, specs):
+        np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)[...] = array
+    return shm, specs
+
+
+def attach_arrays(name, specs):
+    """
+    Attach to arrays in shared memory created with `share_arrays`.
+
+    The arrays must be deleted before the shared memory is closed.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, [
+            np.ndarray(shape, dtype, buffer=shm.buf, offset=offset) for
+            offset, shape, dtype in specs]
+
+
+def _fit_classifier_task(clf, name, specs):
+    """
+    Fit a classifier on arrays in shared memory (used as a pool task).
+    """
+    shm, (matrix, solutions, weights) = attach_arrays(name, specs)
+    try:
+        fit_classifier(
+                clf, matrix.tolist(), solutions.tolist(), weights.copy())
+    finally:
+        del matrix, solutions, weights
+        shm.close()
+    return clf
+
+
+def _undefault(obj):
+    """
+    Convert nested default dictionaries to plain dictionaries for pickling.
+    """
+    if isinstance(obj, defaultdict):
+        return {k: _undefault(v) for k, v in obj.items()}
+    if isinstance(obj, dict):
+        return obj.__class__((k, _undefault(v)) for k, v in obj.items())
+    return obj
+
+
+def _func_key(func):
+    """
+    Return a stable identifier for an alignment function.
+
+    Lambdas, closures, and partials with arguments whose representation
+    differs between runs (like the memory address of an object) have no
+    stable identifier, and raise a `ValueError`.
+    """
+    if isinstance(func, partial):
+        return [_func_key(func.func), [_arg_key(arg) for arg in func.args],
+                sorted((k, _arg_key(v)) for k, v in func.keywords.items())]
+    name = getattr(func, "__qualname__", None)
+    if not name or "<" in name:
+        raise ValueError("{0!r} has no stable identifier".format(func))
+    return "{0}.{1}".format(func.__module__, name)
+
+
+def _arg_key(arg):
+    """
+    Return a stable identifier for an argument of a partial function.
+    """
+    if callable(arg):
+        return _func_key(arg)
+    key = repr(arg)
+    if " at 0x" in key:
+        raise ValueError("{0} has no stable identifier".format(key))
+    return key
+
+
+def _align_key(func):
+    """
+    Return the key under which the rows aligned with a function are kept.
+
+    Functions are their own key, while partials are compared by their
+    function and arguments, since a new partial is often created per call.
+    """
+    if isinstance(func, partial):
+        return (_align_key(func.func),
+                tuple(_align_key(arg) if callable(arg) else repr(arg) for
+                    arg in func.args),
+                tuple(sorted(
+                    (k, _align_key(v) if callable(v) else repr(v)) for k, v in
+                    func.keywords.items())))
+    return func
+
+
+class ModelStore(object):
+    """
+    On-disk cache of fitted models, keyed by training data and parameters.
+
+    :param path: The folder in which the models are stored.
+    :param max_size: The maximal size of the store in bytes. If the store
+        grows beyond this size, the least recently used models are evicted.
+    """
+
+    def __init__(self, path, max_size=2**30):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def key(self, datapath, **params):
+        """
+        Compute the key from the content of the training file and parameters.
+
+        :raises ValueError: If a function among the parameters has no stable
+            identifier, like a lambda or a closure.
+        """
+        digest = _update_digest(hashlib.sha256(), datapath)
+        params = {k: _func_key(v) if callable(v) else v for k, v in
+                params.items()}
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        Return the model stored under the key or None if it is not stored.
+        """
+        path = self.path.joinpath(key+".pkl")
+        try:
+            with open(path, "rb") as f:
+                cls, state = pickle.load(f)
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        model = cls.__new__(cls)
+        model.__dict__.update(state)
+        return model
+
+    def save(self, key, model):
+        """
+        Store a model under the key and evict old models if needed.
+        """
+        path = self.path.joinpath(key+".pkl")
+        tmp = path.with_suffix(".{0}.tmp".format(os.getpid()))
+        with open(tmp, "wb") as f:
+            pickle.dump(
+                    (model.__class__, _undefault(model.__dict__)), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self.evict(keep=path)
+
+    def get(self, key, factory):
+        """
+        Load the model stored under the key or create and store it.
+        """
+        model = self.load(key)
+        if model is None:
+            model = factory()
+            self.save(key, model)
+        return model
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used models until the store fits its size.
+        """
+        models = []
+        for path in self.path.glob("*.pkl"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            models += [(stat.st_mtime, stat.st_size, path)]
+        size = sum(row[1] for row in models)
+        for mtime, fsize, path in sorted(models):
+            if size <= self.max_size:
+                break
+            if path != keep:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                size -= fsize
+
+
+class CorrespondencePatterns(object):
+    """
+    Alignments and correspondence patterns of the cognate sets in a file.
+
+    The cognate sets are aligned once for each language as target, and the
+    aligned rows are kept as arrays, from which the patterns for any
+    classifier can be computed. The rows are kept for each alignment
+    function, so that models with different alignment functions can share
+    the same instance.
+
+    :param datapath: The path to the training data.
+    :param gap: Gap symbol used for alignments.
+    :param missing: Missing data symbol.
+    """
+
+    def __init__(self, datapath, gap="-", missing="Ø"):
+        self.languages, self.sounds, self.data = load_cognate_file(
+                datapath, sounds=False)
+        self.gap, self.missing = gap, missing
+        self.func = None
+        self.aligned = {}
+        self.alignments = {
+                language: [] for language in self.languages}
+        self.to_predict = defaultdict(list)
+
+        for cogid, data in self.data.items():
+            alms, languages = [], []
+            for language in self.languages:
+                if data[language] and \
+                        " ".join(data[language]) != "?":
+                    alms += [data[language]]
+                    languages += [language]
+                elif data[language] and " ".join(data[language]) == "?":
+                    self.to_predict[cogid] += [language]
+            for i, language in enumerate(languages):
+                self.alignments[language].append(
+                        [
+                            cogid,
+                            [lang for lang in languages if lang != language]+[language],
+                            [alm for j, alm in enumerate(alms) if i != j]+[alms[i]]
+                            ]
+                        )
+
+    def align(self, func=simple_align, jobs=1):
+        """
+        Align the cognate sets for each target language, unless they have
+        already been aligned with the same function.
+
+        The rows of the alignments are stored in `rows`, with the target
+        language in the last language column, and the cognate set and row
+        number of each row in `cogids`. Since alignment functions may add
+        features other than sounds, rows are arrays of objects, and `codes`
+        holds the same rows as integers. These attributes refer to the
+        function aligned last, while the rows of all functions are kept in
+        `aligned` and can be retrieved with `get`.
+
+        :param jobs: The number of worker processes, with 0 using all cores.
+            The cognate sets of each language are split into chunks, which
+            are aligned independently and merged in their original order.
+        """
+        key = _align_key(func)
+        if key not in self.aligned:
+            self.aligned[key] = self._align(func, jobs)
+        self.func = func
+        self.rows, self.codes, self.cogids = self.aligned[key]
+
+    def _align(self, func, jobs):
+        """
+        Align the cognate sets and return the rows, codes, and cognate sets.
+        """
+        rows, codes, cogids = {}, {}, {}
+        jobs = jobs or os.cpu_count()
+        if jobs == 1:
+            aligned = {}
+            for language in self.languages:
+                with PROFILER.stage(
+                        "align", items=len(self.alignments[language])):
+                    aligned[language] = _align_task(
+                            func, self.languages, language,
+                            self.alignments[language])
+        else:
+            with PROFILER.stage("align", items=sum(
+                    len(alms) for alms in self.alignments.values())):
+                aligned = self._align_parallel(func, jobs)
+        for language in self.languages:
+            lrows, cogids[language] = aligned[language]
+            rows[language] = np.array(lrows, dtype=object)
+            vocabulary = {}
+            codes[language] = np.array([
+                vocabulary.setdefault(cell, len(vocabulary)) for row in lrows
+                for cell in row], dtype=np.int32).reshape(
+                        rows[language].shape)
+        return rows, codes, cogids
 
+    def get(self, func=None):
+        """
+        Return the rows, codes, and cognate sets aligned with a function.
 
+        :param func: The alignment function, with `None` using the function
+            aligned last. The data must have been aligned with it before.
+        """
+        if func is None:
+            return self.rows, self.codes, self.cogids
+        return self.aligned[_align_key(func)]
 
-def ungap(alignment, languages, proto):
-    cols = []
-    pidxs = []
-    for i, taxon in enumerate(languages):
-        if taxon == proto:
-            pidxs += [i]
-    merges = []
-    for i in range(len(alignment[0])):
-        col = [row[i] for row in alignment]
-        col_rest = [site for j, site in enumerate(col) if j not in pidxs]
-        if "-" in col_rest and len(set(col_rest)) == 1:
-            merges += [i]
-    if merges:
-        new_alms = []
-        for i, row in enumerate(alignment):
-            new_alm = []
-            mergeit = False
-            started = True
-            for j, cell in enumerate(row):
-                if j in merges or mergeit:
-                    mergeit = False
-                    if not started: #j != 0:
-                        if cell == "-":
-                            pass
-                        else:
-                            if not new_alm[-1]:
-                                new_alm[-1] += cell
-                            else:
-                                new_alm[-1] += '.'+cell
-                    else:
-                        mergeit = True
-                        if cell == "-":
-                            new_alm += [""]
-                        else:
-                            new_alm += [cell]
-                else:
-                    started = False
-                    new_alm += [cell]
-            for k, cell in enumerate(new_alm):
-                if not cell:
-                    new_alm[k] = "-"
-            new_alms += [new_alm]
-        return new_alms
-    return alignment
+    def _align_parallel(self, func, jobs):
+        """
+        Align chunks of the cognate sets of all languages in a process pool.
+        """
+        size = max(1, math.ceil(sum(
+            len(alms) for alms in self.alignments.values()) / (4 * jobs)))
+        chunks = [
+                (language, i) for language in self.languages for i in
+                range(0, len(self.alignments[language]), size)]
+        results = {}
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {
+                    pool.submit(
+                        _align_task, func, self.languages, language,
+                        self.alignments[language][i:i+size]): (language, i)
+                    for language, i in chunks}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        aligned = {language: ([], []) for language in self.languages}
+        for language, i in chunks:
+            aligned[language][0].extend(results[language, i][0])
+            aligned[language][1].extend(results[language, i][1])
+        return aligned
 
+    def table(self, language, exclude=(), func=None):
+        """
+        Compute the distinct patterns for a target language.
 
-def simple_align(
-        seqs, 
-        languages, 
-        all_languages,
-        align=True,
-        training=True,
-        missing="Ø", 
-        gap="-",
-        ):
+        :param exclude: The columns of the rows which are not part of the
+            patterns.
+        :param func: The alignment function of the rows, with `None` using
+            the function aligned last.
+        :returns: The distinct combinations of pattern and target sound, the
+            target sounds, and how often each combination occurs. Patterns
+            are ordered by their first occurrence, and target sounds of the
+            same pattern by their first occurrence.
+        """
+        rows, codes, _ = self.get(func)
+        rows, codes = rows[language], codes[language]
+        if not rows.size:
+            return rows.reshape(0, 0), rows.reshape(0), np.zeros(
+                    0, dtype=np.int64)
+        columns = [
+                i for i in range(rows.shape[1]) if i not in exclude]
+        target = len(self.languages)-1
+        pidxs, first, inverse = np.unique(
+                codes[:, columns], axis=0, return_index=True,
+                return_inverse=True)
+        size = codes.max()+1
+        keys, kfirst, counts = np.unique(
+                inverse.reshape(-1).astype(np.int64) * size +
+                codes[:, target], return_index=True, return_counts=True)
+        order = np.lexsort((kfirst, first[keys // size]))
+        idxs = kfirst[order]
+        return rows[idxs][:, columns], rows[idxs, target], counts[order]
+
+
+def _align_task(func, all_languages, language, alignments):
     """
-    Simple alignment function that inserts entries for missing data.
+    Align cognate sets for one target language (used as a pool task).
+
+    :returns: The rows of all alignments and the cognate set and row number
+        of each row.
     """
-    return transform_alignment(
-            seqs, languages, all_languages, align=align,
-            training=training, missing=missing, gap=gap, startend=False,
-            prosody=False, position=False, firstlast=False)
+    rows, cogids = [], []
+    for cogid, languages, alms in alignments:
+        alm_matrix = func(
+                alms, languages, [l for l in all_languages if l !=
+                    language]+[language],
+                training=True)
+        rows += alm_matrix
+        cogids += [(cogid, i) for i in range(len(alm_matrix))]
+    return rows, cogids
+
+
+def extract_patterns(datapath, func=simple_align):
+    """
+    Load the training data and align it for all target languages.
+    """
+    patterns = CorrespondencePatterns(datapath)
+    patterns.align(func)
+    return patterns
 
 
 class Baseline(object):
 
     def __init__(
             self, datapath, minrefs=2, missing="Ø", gap="-", threshold=1,
-            func=simple_align):
+            func=simple_align, patterns=None):
         """
         The baseline is the prediction method by List (2019).
+
+        :param patterns: The `CorrespondencePatterns` of the training data,
+            if they have already been computed.
         """
-        self.languages, self.sounds, self.data = load_cognate_file(datapath)
+        self.patterns = patterns or CorrespondencePatterns(
+                datapath, gap=gap, missing=missing)
+        self.languages, self.sounds, self.data = (
+                self.patterns.languages, None, self.patterns.data)
         self.gap, self.missing = gap, missing
+        self.minrefs, self.threshold = minrefs, threshold
 
         # make a simple numerical embedding for sounds
         self.classifiers = {
             language: CorPaRClassifier(minrefs, missing=0,
                     threshold=threshold) for language in self.languages}
-        self.alignments = {
-                language: [] for language in self.languages} 
-        self.to_predict = defaultdict(list)
-
-        for cogid, data in self.data.items():
-            alms, languages = [], []
-            for language in self.languages:
-                if data[language] and \
-                        " ".join(data[language]) != "?":
-                    alms += [data[language]]
-                    languages += [language]
-                elif data[language] and " ".join(data[language]) == "?":
-                    self.to_predict[cogid] += [language]
-            for i, language in enumerate(languages):
-                self.alignments[language].append(
-                        [
-                            cogid,
-                            [lang for lang in languages if lang != language]+[language],
-                            [alm for j, alm in enumerate(alms) if i != j]+[alms[i]]
-                            ]
-                        )
+        self.alignments = self.patterns.alignments
+        self.to_predict = self.patterns.to_predict
         self.func = func
 
 
-    def fit(self, func=simple_align):
+    def fit(self, func=simple_align, jobs=1):
         """
         Fit the data.
+
+        :param jobs: The number of worker processes in which the data is
+            aligned and the classifiers are fitted, with 0 using all cores.
+            The matrices are passed to the workers in shared memory, and the
+            classifiers are fitted serially if it is not available.
         """
-        self.patterns = defaultdict(lambda : defaultdict(list))
         self.func = func
+        self.patterns.align(func, jobs=jobs)
+        rows = self.patterns.get(func)[0]
         self.matrices = {language: [] for language in self.languages}
         self.solutions = {language: [] for language in self.languages}
-        self.patterns = {
-                language: defaultdict(lambda : defaultdict(list)) for
-                language in self.languages}
+        self.weights = {language: [] for language in self.languages}
+        tables = {}
         sounds = set()
         for language in self.languages:
-            for cogid, languages, alms in self.alignments[language]:
-                alm_matrix = self.func(
-                        #alms, languages, self.languages,
-                        alms, languages, [l for l in self.languages if l !=
-                            language]+[language],
-                        training=True)
-                for i, row in enumerate(alm_matrix):
-                    ptn = tuple(row[:len(self.languages)]+row[len(self.languages)+1:])
-                    self.patterns[language][ptn][row[len(self.languages)-1]] += [(cogid, i)]
-
-                    for sound in ptn:
-                        sounds.add(sound)
-                    sounds.add(row[-1])
+            # the target column is part of the patterns of the baseline
+            tables[language] = self.patterns.table(
+                    language, exclude=[len(self.languages)], func=func)
+            sounds.update(tables[language][0].ravel().tolist())
+            if rows[language].size:
+                sounds.update(rows[language][:, -1].tolist())
         self.sound2idx = dict(zip(sorted(sounds), range(2, len(sounds)+2)))
         self.sound2idx[self.gap] = 1
         self.sound2idx[self.missing] = 0
         self.idx2sound = {v: k for k, v in self.sound2idx.items()}
 
-        for language in progressbar(self.languages, desc="fitting classifiers"):
-            for pattern, sounds in self.patterns[language].items():
-                for sound, vals in sounds.items():
-                    target = self.sound2idx[sound]
-                    row = [self.sound2idx[s] for s in pattern]
-                    for cogid, idx in vals:
-                        self.matrices[language] += [row]
-                        self.solutions[language] += [target]
-            self.classifiers[language].fit(
-                    self.matrices[language],
-                    self.solutions[language])
-    
+        # intern the sounds into a sorted lookup table for bulk encoding
+        self.dtype = np.int16 if len(sounds)+2 < 2**15 else np.int32
+        self.vocabulary = np.array(sorted(self.sound2idx))
+        self.codes = np.array(
+                [self.sound2idx[s] for s in self.vocabulary], dtype=self.dtype)
+        self.decoder = np.array(
+                [self.idx2sound.get(i, "") for i in range(len(sounds)+2)],
+                dtype=object)
+
+        for language in self.languages:
+            patterns, targets, counts = tables[language]
+            self.matrices[language] = self.encode(patterns)
+            self.solutions[language] = self.encode(targets)
+            self.weights[language] = counts.astype(np.int32)
+
+        jobs = min(jobs or os.cpu_count(), len(self.languages))
+        if jobs <= 1 or shared_memory is None:
+            for language in progressbar(
+                    self.languages, desc="fitting classifiers"):
+                with PROFILER.stage(
+                        "classifier", items=len(self.matrices[language])):
+                    fit_classifier(
+                            self.classifiers[language],
+                            self.matrices[language].tolist(),
+                            self.solutions[language].tolist(),
+                            self.weights[language])
+        else:
+            with PROFILER.stage("classifier", items=sum(
+                    len(matrix) for matrix in self.matrices.values())):
+                self._fit_parallel(jobs)
+
+    def _fit_parallel(self, jobs):
+        """
+        Fit the classifiers of all languages in a pool of processes.
+        """
+        shm, specs = share_arrays([
+            array for language in self.languages for array in [
+                self.matrices[language], self.solutions[language],
+                self.weights[language]]])
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                # start with the largest matrices to balance the load
+                futures = {
+                        pool.submit(
+                            _fit_classifier_task,
+                            self.classifiers[language], shm.name,
+                            specs[3*i:3*i+3]): language for i, language in
+                        sorted(
+                            enumerate(self.languages),
+                            key=lambda x: -len(self.matrices[x[1]]))}
+                for future in progressbar(
+                        as_completed(futures), total=len(futures),
+                        desc="fitting classifiers"):
+                    self.classifiers[futures[future]] = future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def encode(self, matrix):
+        """
+        Convert sounds to their integer codes, with unknown sounds as missing.
+        """
+        matrix = np.array(matrix, dtype=str)
+        if not matrix.size:
+            return np.zeros(matrix.shape, dtype=self.dtype)
+        idxs = np.searchsorted(self.vocabulary, matrix).clip(
+                0, len(self.vocabulary)-1)
+        return np.where(
+                self.vocabulary[idxs] == matrix, self.codes[idxs],
+                0).astype(self.dtype)
+
+    def decode(self, codes, unknown="?"):
+        """
+        Convert integer codes back to sounds.
+        """
+        sounds = self.decoder[np.asarray(codes, dtype=np.intp)]
+        sounds[sounds == ""] = unknown
+        return sounds
+
     def predict(self, languages, alignments, target, unknown="?"):
-        
-        matrix = self.func(
-                alignments, languages, [l for l in self.languages if l !=
-                    target],
-                training=False,
-                )
-        new_matrix = [[0 for char in row] for row in matrix]
-        for i, row in enumerate(matrix):
-            for j, char in enumerate(row):
-                new_matrix[i][j] = self.sound2idx.get(char, 0)
-        out = [self.idx2sound.get(idx, unknown) for idx in
-                self.classifiers[target].predict(new_matrix)]
-        return [x for x in out if x != "-"]
-
-
-def predict_words(ifile, pfile, ofile):
-
-    bs = Baseline(ifile)
-    bs.fit()
-    languages, sounds, testdata = load_cognate_file(pfile)
+        return self.predict_batch([(languages, alignments, target)],
+                unknown=unknown)[0]
+
+    def predict_batch(self, items, unknown="?"):
+        """
+        Predict words for many cognate sets with one classifier call per language.
+
+        :param items: Triples of languages, alignments, and target language.
+        :param unknown: The symbol to used for unknown predictions.
+        :returns: The predicted words, in the order of the items.
+        """
+        with PROFILER.stage("predict"):
+            out = self._predict_batch(items, unknown)
+        PROFILER.count("predict", len(out))
+        return out
+
+    def _predict_batch(self, items, unknown):
+        groups = defaultdict(list)
+        for i, (languages, alignments, target) in enumerate(items):
+            matrix = self.func(
+                    alignments, languages, [l for l in self.languages if l !=
+                        target],
+                    training=False,
+                    )
+            groups[target] += [(i, matrix)]
+        out = {}
+        for target, group in groups.items():
+            offsets = np.cumsum([0]+[len(matrix) for i, matrix in group])
+            new_matrix = self.encode(
+                    [row for i, matrix in group for row in matrix])
+            predicted = self.decode(
+                    self.classifiers[target].predict(new_matrix.tolist()),
+                    unknown=unknown).tolist()
+            for (i, matrix), start, end in zip(
+                    group, offsets[:-1], offsets[1:]):
+                out[i] = [x for x in predicted[start:end] if x != "-"]
+        return [out[i] for i in range(len(out))]
+
+
+def _fit_baseline(ifile, jobs=1, func=simple_align):
+    bs = Baseline(ifile, func=func)
+    bs.fit(func=func, jobs=jobs)
+    return bs
+
+
+def read_test_items(pfile):
+    """
+    Read the words that should be predicted from a test file.
+
+    :returns: The pairs of cognate set and target language, and the triples
+        of languages, alignments, and target language passed to the baseline.
+    """
+    with PROFILER.stage("load"):
+        languages, testdata = iter_cognate_file(pfile)
+        items, keys = [], []
+        for cogid, values in testdata:
+            alms, current_languages = [], []
+            target = ""
+            for language in languages:
+                if language in values and " ".join(values[language]) not in ["?", ""]:
+                    alms += [values[language]]
+                    current_languages += [language]
+                elif " ".join(values[language]) == "?":
+                    target = language
+
+            if alms and target:
+                items += [(current_languages, alms, target)]
+                keys += [(cogid, target)]
+        if PROFILER.enabled:
+            PROFILER.count("load", len(items), _read_size(pfile))
+    return keys, items
+
+
+def predict_words(
+        ifile, pfile, ofile, store=None, jobs=1, func=simple_align):
+    """
+    Predict words with the baseline, reusing fitted models from the store.
+
+    :param jobs: The number of processes in which the classifiers are fitted.
+    :param func: The alignment function of the baseline. Passing
+        `partial(simple_align, cache=ALIGNMENT_CACHE)` aligns each cognate
+        set only once for all target languages, but the predictions can
+        then differ from those of the reference baseline.
+    """
+    if store:
+        bs = store.get(
+                store.key(
+                    ifile, model="baseline", minrefs=2, threshold=1,
+                    func=func),
+                partial(_fit_baseline, ifile, jobs, func))
+    else:
+        bs = _fit_baseline(ifile, jobs, func)
+    keys, items = read_test_items(pfile)
     predictions = defaultdict(dict)
-    for cogid, values in progressbar(testdata.items(), desc="predicting words"):
-        alms, current_languages = [], []
-        target = ""
-        for language in languages:
-            if language in values and " ".join(values[language]) not in ["?", ""]:
-                alms += [values[language]]
-                current_languages += [language]
-            elif " ".join(values[language]) == "?":
-                target = language
-
-        if alms and target:
-            out = bs.predict(current_languages, alms, target)
-            predictions[cogid][target] = out
+    for (cogid, target), out in zip(keys, bs.predict_batch(
+            progressbar(items, desc="predicting words"))):
+        predictions[cogid][target] = out
     write_cognate_file(bs.languages, predictions, ofile)
+    return predictions
+
+
+def _predict_task(
+        dataset, prop, datapath, store=None, profile=None,
+        func=simple_align):
+    """
+    Run the baseline on one dataset and proportion (used as a pool task).
+
+    :param profile: The folder for the cProfile statistics, or True, to
+        enable the profiler in a worker and return its statistics.
+    """
+    prop = "{0:.2f}".format(prop)
+    if profile:
+        PROFILER.enable(None if profile is True else profile)
+    PROFILER.label = "{0} / {1}".format(dataset, prop)
+    start = time.time()
+    predictions = predict_words(
+            datapath.joinpath(dataset, "training-"+prop+".tsv"),
+            datapath.joinpath(dataset, "test-"+prop+".tsv"),
+            datapath.joinpath(dataset, "result-"+prop+".tsv"),
+            store=store, func=func
+            )
+    row = [dataset, prop, len(predictions), time.time()-start]
+    if profile:
+        if PROFILER.path:
+            PROFILER.dump_profiles()
+        row += [PROFILER.collect()]
+        PROFILER.reset()
+    return row
+
+
+def predict_all(
+        datasets, datapath, props=None, jobs=1, store=None,
+        func=simple_align):
+    """
+    Predict words with the baseline for all datasets and proportions.
+
+    :param datasets: The datasets, as read from the JSON file.
+    :param datapath: The folder containing the training and test data.
+    :param props: The proportions of test data to analyze.
+    :param jobs: The number of worker processes, with 0 using all cores.
+    :param store: A ModelStore from which fitted models are reused.
+    :param func: The alignment function of the baseline.
+    """
+    props = props or [0.1, 0.2, 0.3, 0.4, 0.5]
+    tasks = [(dataset, prop) for prop in props for dataset in datasets]
+    jobs = jobs or os.cpu_count()
+    summary = []
+    if jobs == 1:
+        for dataset, prop in tasks:
+            print("[i] analyzing {0} / {1:.2f}".format(dataset, prop))
+            summary += [_predict_task(
+                dataset, prop, datapath, store, func=func)]
+    else:
+        # workers send the statistics of the profiler back with the results
+        profile = (PROFILER.path or True) if PROFILER.enabled else None
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [
+                    pool.submit(
+                        _predict_task, dataset, prop, datapath, store,
+                        profile, func) for
+                    dataset, prop in tasks]
+            for i, future in enumerate(as_completed(futures)):
+                summary += [future.result()]
+                if profile:
+                    PROFILER.merge(summary[-1].pop())
+                print("[i] analyzed {0} / {1} ({2}/{3})".format(
+                    summary[-1][0], summary[-1][1], i+1, len(tasks)))
+    summary = sorted(summary)
+    print(tabulate(summary, headers=[
+        "DATASET", "PROPORTION", "WORDS", "SECONDS"], floatfmt=".2f"))
+    return summary
+
+
+def nw_align_batch(pairs, chunksize=1024):
+    """
+    Align many pairs of sequences with the Needleman-Wunsch algorithm.
+
+    The dynamic programming matrices of all pairs in a chunk are filled at
+    once with NumPy. Scores and tie-breaking follow `lingpy.nw_align` with
+    its default scorer (1 for matches, -1 for mismatches and gaps), so the
+    alignments and scores are identical. Identical sequences are returned
+    unaligned.
+
+    :returns: Triples of first and second aligned sequence and score, like
+        those of `lingpy.nw_align`.
+    """
+    out = [None for pair in pairs]
+    todo = []
+    for k, (seqA, seqB) in enumerate(pairs):
+        if list(seqA) == list(seqB):
+            out[k] = (list(seqA), list(seqB), len(seqA))
+        elif not seqA or not seqB:
+            out[k] = tuple(nw_align(seqA, seqB))
+        else:
+            todo += [k]
+    for start in range(0, len(todo), chunksize):
+        chunk = todo[start:start+chunksize]
+        vocabulary = {}
+        lengthsA = np.array([len(pairs[k][0]) for k in chunk])
+        lengthsB = np.array([len(pairs[k][1]) for k in chunk])
+        A = np.full((len(chunk), lengthsA.max()), -1, dtype=np.int32)
+        B = np.full((len(chunk), lengthsB.max()), -2, dtype=np.int32)
+        for row, k in enumerate(chunk):
+            A[row, :lengthsA[row]] = [vocabulary.setdefault(
+                x, len(vocabulary)) for x in pairs[k][0]]
+            B[row, :lengthsB[row]] = [vocabulary.setdefault(
+                x, len(vocabulary)) for x in pairs[k][1]]
+        scores = np.where(B[:, :, None] == A[:, None, :], 1, -1)
+
+        # fill the matrix, with rows for seqB and columns for seqA
+        M, N = A.shape[1], B.shape[1]
+        matrix = np.zeros((len(chunk), N+1, M+1), dtype=np.int32)
+        trace = np.zeros((len(chunk), N+1, M+1), dtype=np.int8)
+        matrix[:, 0, :] = -np.arange(M+1)
+        matrix[:, :, 0] = -np.arange(N+1)
+        trace[:, 0, 1:], trace[:, 1:, 0] = 2, 3
+        for i in range(1, N+1):
+            for j in range(1, M+1):
+                gapA = matrix[:, i-1, j] - 1
+                gapB = matrix[:, i, j-1] - 1
+                match = matrix[:, i-1, j-1] + scores[:, i-1, j-1]
+                takeA = (gapA >= match) & (gapA >= gapB)
+                takeM = ~takeA & (match >= gapB)
+                matrix[:, i, j] = np.where(
+                        takeA, gapA, np.where(takeM, match, gapB))
+                trace[:, i, j] = np.where(takeA, 3, np.where(takeM, 1, 2))
+
+        # trace back all pairs simultaneously
+        rows = np.arange(len(chunk))
+        i, j = lengthsB.copy(), lengthsA.copy()
+        final = matrix[rows, i, j].tolist()
+        steps = []
+        while (i > 0).any() or (j > 0).any():
+            step = trace[rows, i, j]
+            steps += [step]
+            i -= (step == 3) | (step == 1)
+            j -= (step == 1) | (step == 2)
+        steps = np.array(steps)[::-1].T
+        for row, k in enumerate(chunk):
+            seqA, seqB = pairs[k]
+            almA, almB, a, b = [], [], 0, 0
+            for step in steps[row][steps[row] > 0]:
+                if step == 3:
+                    almA += ["-"]
+                    almB += [seqB[b]]
+                    b += 1
+                elif step == 1:
+                    almA += [seqA[a]]
+                    almB += [seqB[b]]
+                    a += 1
+                    b += 1
+                else:
+                    almA += [seqA[a]]
+                    almB += ["-"]
+                    a += 1
+            out[k] = (almA, almB, final[row])
+    return out
+
+
+def _ngrams(seqs, lengths, n):
+    """
+    Number the padded n-grams of encoded sequences.
+
+    The sequences are padded with n-1 symbols (encoded as 0) on both sides,
+    as in `lingrex.util.bleu_score`.
+
+    :returns: The number of each n-gram and the index of its sequence.
+    """
+    width = lengths.max() + 2 * (n-1)
+    padded = np.zeros((len(seqs), width), dtype=np.int64)
+    rows = np.repeat(np.arange(len(seqs)), lengths)
+    padded[rows, n-1 + np.arange(len(rows)) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths)] = np.concatenate(seqs)
+    columns = width - n + 1
+    valid = np.arange(columns) < (lengths + n - 1)[:, None]
+    ids = np.zeros(valid.sum(), dtype=np.int64)
+    for k in range(n):
+        # renumber after each position to keep the numbers small
+        ids = np.unique(
+                ids * (padded.max()+1) + padded[:, k:k+columns][valid],
+                return_inverse=True)[1].reshape(-1)
+    return ids, np.nonzero(valid)[0]
+
+
+def bleu_scores(pairs, n=4):
+    """
+    Compute BLEU scores for many pairs of predicted word and reference.
+
+    The scores are identical to `lingrex.util.bleu_score` without trimming.
+    The n-grams of all pairs are counted at once with NumPy, and identical
+    words score 1.
+    """
+    out = [1.0 for pair in pairs]
+    todo = [k for k, (word, reference) in enumerate(pairs) if
+            list(word) != list(reference)]
+    if not todo:
+        return out
+    vocabulary = {}
+    seqs = [
+            np.array([vocabulary.setdefault(x, len(vocabulary)+1) for x in
+                seq], dtype=np.int64) for k in todo for seq in pairs[k]]
+    lengths = np.array([len(seq) for seq in seqs])
+    weights, precisions = [1 / n for i in range(n)], []
+    for i in range(1, n+1):
+        # words and references alternate, so their n-grams share numbers
+        ids, idxs = _ngrams(seqs, lengths, i)
+        size = ids.max() + 1
+        is_word = idxs % 2 == 0
+        wkeys = np.unique(idxs[is_word] // 2 * size + ids[is_word])
+        rkeys, counts = np.unique(
+                idxs[~is_word] // 2 * size + ids[~is_word],
+                return_counts=True)
+        pos = np.searchsorted(rkeys, wkeys)
+        hits = pos < len(rkeys)
+        hits[hits] = rkeys[pos[hits]] == wkeys[hits]
+        matches = np.bincount(
+                wkeys[hits] // size, weights=counts[pos[hits]],
+                minlength=len(todo))
+        precisions += [(matches / (lengths[::2] + i - 1)).tolist()]
+    # powers are taken in Python, whose results can differ from NumPy's
+    for k, lw, lr, row in zip(
+            todo, lengths[::2].tolist(), lengths[1::2].tolist(),
+            zip(*precisions)):
+        out_score = 1
+        for precision, weight in zip(row, weights):
+            out_score = out_score * (precision ** weight)
+        bp = 1 if lw > lr else math.e ** (1 - (lr / lw))
+        out[k] = bp * (out_score ** (1 / sum(weights)))
+    return out
+
+
+def evaluate_pairs(pairs, chunksize=1024):
+    """
+    Compute alignments, edit distances, and BLEU scores for many pairs.
+
+    The pairs are aligned in chunks, and the results are yielded one by
+    one, so that the alignments of earlier chunks can be discarded. The
+    edit distances follow from the alignment scores (matches count 1, and
+    mismatches and gaps -1) and the lengths of the alignments.
+
+    :returns: A generator of lists of first and second alignment, edit
+        distance, normalized edit distance, and BLEU score for each pair.
+    """
+    for start in range(0, len(pairs), chunksize):
+        chunk = pairs[start:start+chunksize]
+        alignments = nw_align_batch(chunk, chunksize=chunksize)
+        lengths = np.array([len(almA) for almA, almB, score in alignments])
+        distances = (lengths - np.array([
+            score for almA, almB, score in alignments])) // 2
+        for (almA, almB, score), distance, normalized, bleu in zip(
+                alignments, distances.tolist(),
+                (distances / lengths).tolist(), bleu_scores(chunk)):
+            yield [almA, almB, distance, normalized, bleu]
+
+
+class BCubed(object):
+    """
+    Compute B-Cubed precision and recall from aligned sequences.
+
+    Instead of collecting all aligned segments, only the number of times two
+    segments are aligned with each other is stored, so alignments can be
+    added one by one. The scores are those of `_get_bcubed_score` in
+    lingpy for the concatenated alignments (up to rounding).
+    """
+    def __init__(self):
+        self.pairs = Counter()
+        self.first = Counter()
+        self.second = Counter()
+        self.length = 0
+
+    def update(self, almA, almB):
+        self.pairs.update(zip(almA, almB))
+        self.first.update(almA)
+        self.second.update(almB)
+        self.length += len(almB)
+
+    def scores(self):
+        """
+        :returns: The precision and the recall.
+        """
+        precision, recall = 0.0, 0.0
+        for (a, b), count in self.pairs.items():
+            precision += count * count / self.first[a]
+            recall += count * count / self.second[b]
+        return precision / self.length, recall / self.length
 
 
 def compare_words(firstfile, secondfile, report=True):
@@ -432,30 +1903,26 @@ def compare_words(firstfile, secondfile, report=True):
     Evaluate the predicted and attested words in two datasets.
     """
 
-    (languages, soundsA, first), (languagesB, soundsB, last) = load_cognate_file(firstfile), load_cognate_file(secondfile)
+    (languages, soundsA, first), (languagesB, soundsB, last) = (
+            load_cognate_file(firstfile, sounds=False),
+            load_cognate_file(secondfile, sounds=False))
     all_scores = []
     for language in languages:
-        scores = []
-        almsA, almsB = [], []
+        keys, pairs = [], []
         for key in first:
             if language in first[key]:
                 entryA = first[key][language]
                 if " ".join(entryA):
-                    entryB = last[key][language]
-                    almA, almB, _ = nw_align(entryA, entryB)
-                    almsA += almA
-                    almsB += almB
-                    score = 0
-                    for a, b in zip(almA, almB):
-                        if a == b and a not in "Ø?-":
-                            pass
-                        elif a != b:
-                            score += 1
-                    scoreD = score / len(almA)
-                    bleu = bleu_score(entryA, entryB, n=4, trim=False)
-                    scores += [[key, entryA, entryB, score, scoreD, bleu]]
+                    keys += [key]
+                    pairs += [(entryA, last[key][language])]
+        scores = []
+        bcubed = BCubed()
+        for key, (entryA, entryB), (almA, almB, score, scoreD, bleu) in zip(
+                keys, pairs, evaluate_pairs(pairs)):
+            bcubed.update(almA, almB)
+            scores += [[key, entryA, entryB, score, scoreD, bleu]]
         if scores:
-            p, r = bcubed_score(almsA, almsB), bcubed_score(almsB, almsA)
+            p, r = bcubed.scores()
             fs = 2 * (p*r) / (p+r)
             all_scores += [[
                 language,
@@ -478,7 +1945,262 @@ def compare_words(firstfile, secondfile, report=True):
                         "Language", "ED", "ED (Normalized)", 
                         "B-Cubed FS", "BLEU"], floatfmt=".3f"))
     return all_scores
-    
+
+
+def _evaluate_task(system, dataset, prop, datapath):
+    """
+    Evaluate one system on one dataset and proportion (used as a pool task).
+    """
+    prop = "{0:.2f}".format(prop)
+    result = Path(system).joinpath(dataset, "result-"+prop+".tsv")
+    if not result.exists():
+        return None
+    scores = compare_words(
+            result,
+            datapath.joinpath(dataset, "solutions-"+prop+".tsv"),
+            report=False)[-1]
+    return [str(system), dataset, prop] + scores[1:]
+
+
+def write_evaluation(results, path):
+    """
+    Write evaluation results to a JSON or a CSV file.
+
+    :param results: The rows returned by `evaluate_all`.
+    :param path: The output file, with the format determined by the suffix.
+    """
+    path = Path(path)
+    headers = [
+            "system", "dataset", "proportion", "ed", "ed_normalized",
+            "bcubed_fs", "bleu"]
+    if path.suffix == ".json":
+        with open(path, "w") as f:
+            json.dump(
+                    [dict(zip(headers, row)) for row in results], f,
+                    indent=2)
+    elif path.suffix == ".csv":
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(headers)
+            writer.writerows(results)
+    else:
+        raise ValueError(
+                "unknown format {0}, use .json or .csv".format(path.suffix))
+
+
+def evaluate_all(
+        datasets, datapath, systems=None, props=None, jobs=1, output=None):
+    """
+    Evaluate the results of several systems for all datasets and proportions.
+
+    :param datasets: The datasets, as read from the JSON file.
+    :param datapath: The folder containing the solutions.
+    :param systems: The folders containing the results of each system
+        (defaults to the datapath with the results of the baseline).
+    :param props: The proportions of test data to evaluate.
+    :param jobs: The number of worker processes, with 0 using all cores.
+    :param output: A JSON or CSV file to which the results are written.
+    """
+    systems = systems or [datapath]
+    props = props or [0.1, 0.2, 0.3, 0.4, 0.5]
+    tasks = [
+            (system, dataset, prop) for system in systems for prop in props
+            for dataset in datasets]
+    jobs = jobs or os.cpu_count()
+    results = []
+    if jobs == 1:
+        for system, dataset, prop in tasks:
+            results += [_evaluate_task(system, dataset, prop, datapath)]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(
+                partial(_evaluate_task, datapath=datapath),
+                *zip(*tasks)))
+    for (system, dataset, prop), row in zip(tasks, results):
+        if not row:
+            print("[i] no results for {0} / {1} / {2:.2f}".format(
+                system, dataset, prop))
+    results = sorted([row for row in results if row])
+
+    # add the averages over datasets for each system and proportion
+    table = []
+    for system in systems:
+        for prop in props:
+            rows = [row for row in results if row[0] == str(system) and
+                    row[2] == "{0:.2f}".format(prop)]
+            if rows:
+                table += rows + [[
+                    str(system), "TOTAL", rows[0][2]] + [
+                        sum([row[i] for row in rows])/len(rows) for i in
+                        range(3, 7)]]
+    print(tabulate(table, headers=[
+        "SYSTEM", "DATASET", "PROPORTION", "ED", "ED (NORM)",
+        "B-CUBED FS", "BLEU"], floatfmt=".3f"))
+    if output:
+        write_evaluation(table, output)
+    return table
+
+
+def measure(func, repeat=1, memory=True, setup=None):
+    """
+    Time a function and record the peak memory it allocates.
+
+    The time is the minimum of `repeat` runs. Since tracing allocations
+    slows Python down, the peak memory is taken from one additional run.
+    The function `setup` is called before each run and is not timed.
+
+    :returns: The result of the last run, the seconds, and the peak memory
+        in bytes (None if memory is not traced).
+    """
+    seconds = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        seconds += [time.perf_counter()-start]
+    peak = None
+    if memory:
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            result = func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, min(seconds), peak
+
+
+def _benchmark_meta():
+    meta = {
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "commit": None
+            }
+    try:
+        meta["commit"] = Repo(
+                sigtypst2022_path(), search_parent_directories=True
+                ).head.commit.hexsha
+    except Exception:
+        pass
+    return meta
+
+
+def benchmark(
+        datasets, datapath, cldfdatapath=None, props=None, repeat=1,
+        memory=True, runs=100, output=None):
+    """
+    Benchmark all stages of the shared task pipeline.
+
+    Stages are timed for each dataset (`prepare`, if the CLDF data is
+    available, and `split_data`) and for each dataset and proportion
+    (`fit`, `predict`, `predict_words`, and `compare_words`), using the
+    training and test data in the datapath. All files are written to a
+    temporary folder. The peak memory of `prepare` is not traced, since
+    running the cognate detection a second time takes too long.
+
+    :param runs: The number of runs for the cognate detection in `prepare`.
+    :param output: A JSON file to which the results are written.
+    :returns: The metadata and the results of all stages.
+    """
+    props = props or [0.1, 0.2, 0.3, 0.4, 0.5]
+    results = []
+
+    def add(dataset, prop, stage, func, size=None, setup=None, trace=True):
+        print("[i] benchmarking {0} / {1} / {2}".format(
+            dataset, prop or "-", stage))
+        result, seconds, peak = measure(
+                func, repeat=repeat, memory=memory and trace, setup=setup)
+        results.append({
+            "dataset": dataset, "proportion": prop, "stage": stage,
+            "seconds": seconds, "peak_memory": peak,
+            "items": size(result) if size else None})
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        def clean():
+            shutil.rmtree(tmp.joinpath("prepare"), ignore_errors=True)
+            tmp.joinpath("prepare").mkdir()
+
+        for dataset, conditions in datasets.items():
+            tmp.joinpath(dataset).mkdir()
+            if cldfdatapath and cldfdatapath.joinpath(
+                    dataset, "cldf", "cldf-metadata.json").exists():
+                add(dataset, None, "prepare", partial(
+                    prepare, {dataset: conditions}, tmp.joinpath("prepare"),
+                    cldfdatapath, runs=runs, force=True), setup=clean,
+                    trace=False)
+            shutil.copy(
+                    datapath.joinpath(dataset, "cognates.tsv"),
+                    tmp.joinpath(dataset, "cognates.tsv"))
+            add(dataset, None, "split_data", partial(
+                split_data, [dataset], tmp, props=props))
+            for prop in props:
+                prop = "{0:.2f}".format(prop)
+                training = datapath.joinpath(
+                        dataset, "training-"+prop+".tsv")
+                test = datapath.joinpath(dataset, "test-"+prop+".tsv")
+                result = tmp.joinpath(dataset, "result-"+prop+".tsv")
+                bs = add(dataset, prop, "fit", partial(
+                    _fit_baseline, training))
+                keys, items = read_test_items(test)
+                add(dataset, prop, "predict",
+                    lambda: [bs.predict(*item) for item in items], len)
+                add(dataset, prop, "predict_words", partial(
+                    predict_words, training, test, result), len)
+                add(dataset, prop, "compare_words", partial(
+                    compare_words, result,
+                    datapath.joinpath(dataset, "solutions-"+prop+".tsv"),
+                    report=False))
+    benchmarks = {"meta": _benchmark_meta(), "results": results}
+    benchmarks["meta"]["repeat"] = repeat
+    print(tabulate(
+        [[row["dataset"], row["proportion"] or "", row["stage"],
+            row["seconds"], row["peak_memory"] and row["peak_memory"] / 2**20]
+            for row in results],
+        headers=["DATASET", "PROPORTION", "STAGE", "SECONDS", "PEAK (MB)"],
+        floatfmt=".2f"))
+    if output:
+        with open(output, "w") as f:
+            json.dump(benchmarks, f, indent=2)
+    return benchmarks
+
+
+def compare_benchmarks(old, new, tolerance=0.1):
+    """
+    Compare two benchmark files and report stages that became slower.
+
+    :param old: The JSON file with the earlier results.
+    :param new: The JSON file with the later results.
+    :param tolerance: The relative slowdown that is still accepted.
+    :returns: The rows of all stages that became slower.
+    """
+    with open(old) as f:
+        old = {
+                (row["dataset"], row["proportion"], row["stage"]): row for
+                row in json.load(f)["results"]}
+    with open(new) as f:
+        new = json.load(f)["results"]
+    table, regressions = [], []
+    for row in new:
+        key = (row["dataset"], row["proportion"], row["stage"])
+        if key in old:
+            ratio = row["seconds"] / max(old[key]["seconds"], 1e-9)
+            table += [[
+                row["dataset"], row["proportion"] or "", row["stage"],
+                old[key]["seconds"], row["seconds"], ratio,
+                "slower" if ratio > 1 + tolerance else ""]]
+            if ratio > 1 + tolerance:
+                regressions += [table[-1]]
+    print(tabulate(table, headers=[
+        "DATASET", "PROPORTION", "STAGE", "OLD", "NEW", "RATIO", ""],
+        floatfmt=".2f"))
+    return regressions
+
 
 def main(*args):
 
@@ -488,6 +2210,13 @@ def main(*args):
             action="store_true",
             help="Download data via GIT."
             )
+    parser.add_argument(
+            "--mirror",
+            default=None,
+            type=Path,
+            action="store",
+            help="Folder with archives or bare GIT repositories used instead of GitHub."
+            )
     parser.add_argument(
             "--datapath",
             default=Path("data"),
@@ -507,11 +2236,34 @@ def main(*args):
             action="store_true",
             help="Prepare data by conducting cognate judgments."
             )
+    parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Prepare all datasets, even if their input has not changed."
+            )
+    parser.add_argument(
+            "--threshold",
+            action="store",
+            type=float,
+            default=0.45,
+            help="Threshold for automatic cognate detection (default=0.45)."
+            )
+    parser.add_argument(
+            "--cluster-method",
+            action="store",
+            default="infomap",
+            help="Cluster method for automatic cognate detection (default=infomap)."
+            )
     parser.add_argument(
             "--split",
             action="store_true",
             help="Split data into test and training data."
             )
+    parser.add_argument(
+            "--binary",
+            action="store_true",
+            help="Write binary copies of the split data for faster loading."
+            )
     parser.add_argument(
             "--runs",
             action="store",
@@ -591,12 +2343,93 @@ def main(*args):
             default=0.2,
             help="Define the proportion of test data to analyze with the baseline."
             )
+    parser.add_argument(
+            "--proportions",
+            action="store",
+            type=float,
+            nargs="+",
+            default=None,
+            help="Analyze several proportions at once (overrides --proportion)."
+            )
+    parser.add_argument(
+            "--jobs",
+            action="store",
+            type=int,
+            default=1,
+            help="Number of worker processes, with 0 using all cores (default=1)."
+            )
     parser.add_argument(
             "--test-path",
             action="store",
             default=None,
             help="Provide path to the test data for a given system"
             )
+    parser.add_argument(
+            "--systems",
+            action="store",
+            type=Path,
+            nargs="+",
+            default=None,
+            help="Evaluate the results of several systems (overrides --test-path)."
+            )
+    parser.add_argument(
+            "--evaluation-file",
+            action="store",
+            type=Path,
+            default=None,
+            help="JSON or CSV file to which the evaluation is written."
+            )
+
+    parser.add_argument(
+            "--profile",
+            action="store_true",
+            help="Report calls, time, items, and bytes read for each stage."
+            )
+    parser.add_argument(
+            "--profile-path",
+            action="store",
+            type=Path,
+            default=None,
+            help="Folder to which statistics and cProfile output of each stage are written."
+            )
+    parser.add_argument(
+            "--benchmark",
+            action="store_true",
+            help="Time all stages of the pipeline for the datasets."
+            )
+    parser.add_argument(
+            "--benchmark-file",
+            action="store",
+            type=Path,
+            default=None,
+            help="JSON file to which the benchmark results are written."
+            )
+    parser.add_argument(
+            "--benchmark-runs",
+            action="store",
+            type=int,
+            default=100,
+            help="Iterations for cognate detection in the benchmark (default=100)."
+            )
+    parser.add_argument(
+            "--model-cache",
+            action="store",
+            type=Path,
+            default=None,
+            help="Folder in which fitted models are cached for later runs."
+            )
+    parser.add_argument(
+            "--model-cache-size",
+            action="store",
+            type=int,
+            default=1024,
+            help="Maximal size of the model cache in MB (default=1024)."
+            )
+    parser.add_argument(
+            "--alignment-cache",
+            action="store_true",
+            help="Align each cognate set once for all target languages (predictions can differ from the reference baseline)."
+            )
 
     args = parser.parse_args(*args)
     if args.seed:
@@ -607,48 +2440,65 @@ def main(*args):
 
 
     if args.download:
-        download(DATASETS, args.cldf_data)
+        download(
+                DATASETS, args.cldf_data, jobs=args.jobs, mirror=args.mirror)
     
     if args.prepare:
-        prepare(DATASETS, args.datapath, args.cldf_data, args.runs)
+        prepare(
+                DATASETS, args.datapath, args.cldf_data, args.runs,
+                force=args.force, jobs=args.jobs, threshold=args.threshold,
+                cluster_method=args.cluster_method)
     
     if args.split:
-        split_data(DATASETS, args.datapath, props=None)
+        split_data(
+                DATASETS, args.datapath, props=None, binary=args.binary,
+                jobs=args.jobs)
+
 
+    if args.profile:
+        PROFILER.enable(args.profile_path)
 
     if args.predict:
-        prop = "{0:.2f}".format(args.proportion)
+        store = None
+        func = simple_align
+        if args.alignment_cache:
+            func = partial(simple_align, cache=ALIGNMENT_CACHE)
+        if args.model_cache:
+            store = ModelStore(
+                    args.model_cache, max_size=args.model_cache_size*2**20)
         if not args.all:
             if not args.outfile:
                 args.outfile = Path(str(args.infile)[:-4]+"-out.tsv")
-            predict_words(args.infile, args.testfile, args.outfile)
+            PROFILER.label = args.infile.name
+            predict_words(
+                    args.infile, args.testfile, args.outfile, store=store,
+                    jobs=args.jobs, func=func)
         elif args.all:
-            for data, conditions in DATASETS.items():
-                print("[i] analyzing {0}".format(data))
-                predict_words(
-                        args.datapath.joinpath(data, "training-"+prop+".tsv"),
-                        args.datapath.joinpath(data, "test-"+prop+".tsv"),
-                        args.datapath.joinpath(data, "result-"+prop+".tsv")
-                        )
+            predict_all(
+                    DATASETS, args.datapath,
+                    props=args.proportions or [args.proportion],
+                    jobs=args.jobs, store=store, func=func)
     if args.evaluate:
-        prop = "{0:.2f}".format(args.proportion)
         if args.all:
-            if not args.test_path:
-                pth = args.datapath
-            else:
-                pth = Path(args.test_path)
-            results = []
-            for data, conditions in DATASETS.items():
-                results += [compare_words(
-                        pth.joinpath(data, "result-"+prop+".tsv"),
-                        args.datapath.joinpath(data,
-                            "solutions-"+prop+".tsv"),
-                        report=False)[-1]]
-                results[-1][0] = data
-            print(tabulate(sorted(results), headers=[
-                "DATASET", "ED", "ED (NORM)", "B-CUBED FS", "BLEU"], floatfmt=".3f"))
+            systems = args.systems or [
+                    Path(args.test_path) if args.test_path else args.datapath]
+            evaluate_all(
+                    DATASETS, args.datapath, systems=systems,
+                    props=args.proportions or [args.proportion],
+                    jobs=args.jobs, output=args.evaluation_file)
 
 
     if args.compare:
         compare_words(args.prediction_file, args.solution_file)
 
+    if args.profile:
+        PROFILER.report()
+        if args.profile_path:
+            PROFILER.dump()
+
+    if args.benchmark:
+        benchmark(
+                DATASETS, args.datapath, args.cldf_data,
+                props=args.proportions or [args.proportion],
+                runs=args.benchmark_runs, output=args.benchmark_file)
+
@@ -4,8 +4,11 @@ Test List et al.'s SVM-based CorPaR-classifer on the data.
 from lingrex.reconstruct import transform_alignment, OneHot
 from sklearn.svm import SVC
 from functools import partial
-from sigtypst2022 import sigtypst2022_path, load_cognate_file, write_cognate_file
-from collections import defaultdict
+from sigtypst2022 import (
+        sigtypst2022_path, write_cognate_file, iter_cognate_file,
+        ModelStore, CorrespondencePatterns)
+from collections import defaultdict, Counter
+import numpy as np
 from tqdm import tqdm as progressbar
 import argparse
 
@@ -25,32 +28,18 @@ class CorPaRSVM(object):
     """
 
     def __init__(
-            self, datapath, gap="-", missing="Ø"):
-        self.languages, self.sounds, self.data = load_cognate_file(datapath)
+            self, datapath, gap="-", missing="Ø", patterns=None):
+        self.patterns = patterns or CorrespondencePatterns(
+                datapath, gap=gap, missing=missing)
+        self.languages, self.sounds, self.data = (
+                self.patterns.languages, None, self.patterns.data)
         self.gap, self.missing = gap, missing
 
         # make a simple numerical embedding for sounds
         self.classifiers = {
             language: SVC(kernel="linear") for language in self.languages}
         self.onehots = {}
-        self.alignments = {
-                language: [] for language in self.languages} 
-
-        for cogid, data in self.data.items():
-            alms, languages = [], []
-            for language in self.languages:
-                if data[language] and \
-                        " ".join(data[language]) != "?":
-                    alms += [data[language]]
-                    languages += [language]
-            for i, language in enumerate(languages):
-                self.alignments[language].append(
-                        [
-                            cogid,
-                            [lang for lang in languages if lang != language]+[language],
-                            [alm for j, alm in enumerate(alms) if i != j]+[alms[i]]
-                            ]
-                        )
+        self.alignments = self.patterns.alignments
 
 
     def fit(self, func=align_f):
@@ -60,32 +49,24 @@ class CorPaRSVM(object):
         :param func: The alignment function to be used to align the data.
         """
         print("[i] fit the clf")
-        self.patterns = defaultdict(lambda : defaultdict(list))
         self.func = func
+        self.patterns.align(func)
+        aligned = self.patterns.get(func)[0]
         self.matrices = {language: [] for language in self.languages}
         self.solutions = {language: [] for language in self.languages}
-        self.patterns = {
-                language: defaultdict(lambda : defaultdict(list)) for
-                language in self.languages}
         self.sounds2idxs = {language: {self.gap: 1, self.missing: 0} for
                 language in self.languages}
         self.tsounds2idxs = {language: {self.gap: 1, self.missing: 0} for
                 language in self.languages}
         self.idxs2sounds = {language: {} for language in self.languages}
         self.idxs2tsounds = {language: {} for language in self.languages}
-        for language in progressbar(self.languages, desc="aligning data"):
-            sounds, tsounds = defaultdict(int), defaultdict(int)
-            for cogid, languages, alms in self.alignments[language]:
-                alm_matrix = self.func(
-                        alms, languages, 
-                        [l for l in self.languages if l != language]+[language], 
-                        training=True)
-                for i, row in enumerate(alm_matrix):
-                    ptn = tuple(row[:len(self.languages)-1]+row[len(self.languages):])
-                    self.patterns[language][ptn][row[len(self.languages)-1]] += [(cogid, i)]
-                    for sound in ptn:
-                        sounds[sound] += 1
-                    tsounds[row[len(self.languages)-1]] += 1
+        target = len(self.languages)-1
+        for language in self.languages:
+            rows = aligned[language]
+            sounds, tsounds = Counter(), Counter()
+            if rows.size:
+                sounds.update(np.delete(rows, target, axis=1).ravel().tolist())
+                tsounds.update(rows[:, target].tolist())
             for i, sound in enumerate(sorted(sounds, key=lambda x: sounds[x], reverse=True)):
                 self.sounds2idxs[language][sound] = i+2
             for i, sound in enumerate(sorted(tsounds, key=lambda x: tsounds[x], reverse=True)):
@@ -96,13 +77,16 @@ class CorPaRSVM(object):
                     self.tsounds2idxs[language].items()}
 
         for language in progressbar(self.languages, desc="fitting classifiers"):
-            for pattern, sounds in self.patterns[language].items():
-                for sound, vals in sounds.items():
-                    target = self.tsounds2idxs[language][sound]
-                    row = [self.sounds2idxs[language][s] for s in pattern]
-                    for cogid, idx in vals:
-                        self.matrices[language] += [row]
-                        self.solutions[language] += [target]
+            patterns, targets, counts = self.patterns.table(
+                    language, exclude=[target], func=func)
+            # the SVM is trained on all rows, since weighting the distinct
+            # patterns by their counts changes its decision function
+            self.matrices[language] = [
+                    [self.sounds2idxs[language][s] for s in pattern] for
+                    pattern in np.repeat(patterns, counts, axis=0).tolist()]
+            self.solutions[language] = [
+                    self.tsounds2idxs[language][sound] for sound in
+                    np.repeat(targets, counts).tolist()]
             self.onehots[language] = OneHot(self.matrices[language])
 
             self.classifiers[language].fit(
@@ -136,6 +120,12 @@ class CorPaRSVM(object):
         return [x for x in out if x != "-"]
 
 
+def fit_svm(datapath):
+    clf = CorPaRSVM(datapath)
+    clf.fit()
+    return clf
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Demo of SVM CorPaR Method')
@@ -144,8 +134,15 @@ if __name__ == "__main__":
             action="store_true",
             help="Analyze surprise data."
             )
+    parser.add_argument(
+            "--model-cache",
+            action="store",
+            default=None,
+            help="Folder in which fitted classifiers are cached."
+            )
 
     args = parser.parse_args()
+    store = ModelStore(args.model_cache) if args.model_cache else None
     
     datapath, outpath = "data", "training"
     if args.surprise:
@@ -166,17 +163,21 @@ if __name__ == "__main__":
             ds = str(f1).split("/")[-2]
             print("[i] analyzing dataset {0}".format(ds))
 
-            # fit the classifiers
-            clf = CorPaRSVM(f1)
-            clf.fit()
+            # fit the classifiers or load them from the cache
+            if store:
+                clf = store.get(
+                        store.key(f1, model="corpar-svm", func=align_f),
+                        partial(fit_svm, f1))
+            else:
+                clf = fit_svm(f1)
 
             # load the test data
-            languages, sounds, testdata = load_cognate_file(f2)
+            languages, testdata = iter_cognate_file(f2)
             predictions = defaultdict(dict)
 
             # iterate over cognate sets and prepare the words from which to
             # predict
-            for cogid, values in progressbar(testdata.items(), desc="predicting words"):
+            for cogid, values in progressbar(testdata, desc="predicting words"):
                 alms, current_languages = [], []
                 target = ""
                 for language in languages:
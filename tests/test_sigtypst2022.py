@@ -2,9 +2,27 @@ from pathlib import Path
 from sigtypst2022 import (
         CorPaRClassifier, Baseline, download, prepare,
         load_cognate_file, write_cognate_file, 
-        split_training_test_data, split_data, simple_align,
-        predict_words, compare_words)
+        split_training_test_data, split_data, simple_align, fit_classifier,
+        predict_words, predict_all, compare_words, ModelStore,
+        AlignmentCache, iter_cognate_file, read_cognate_binary, binary_path,
+        get_partial_scorer, get_cached_partial_scorer, checksum,
+        evaluate_pairs, evaluate_all, BCubed, benchmark, compare_benchmarks,
+        Profiler, PROFILER, ungap, ungap_batch, CorrespondencePatterns,
+        extract_patterns, share_arrays, attach_arrays, nw_align_batch,
+        bleu_scores)
+from lingpy import Wordlist, nw_align
+from lingrex.util import bleu_score
+from lingpy.evaluate.acd import _get_bcubed_score
+from git import Repo, Actor
+from lingpy.compare.partial import Partial
+from functools import partial
+import sigtypst2022
 import tempfile
+import numpy as np
+import json
+import pytest
+import tarfile
+import shutil
 
 
 DATASETS = {
@@ -29,20 +47,92 @@ def data_path(*comps):
 
 def test_download():
     with tempfile.TemporaryDirectory() as f:
+        for dataset in DATASETS:
+            with tarfile.open(
+                    Path(f).joinpath(dataset+".tar.gz"), "w:gz") as tar:
+                tar.add(data_path("cldf", dataset), arcname=dataset+"-main")
         download(
                 DATASETS,
-                Path(f))
+                Path(f).joinpath("cldf-data"),
+                mirror=Path(f))
+        assert Path(f).joinpath(
+                "cldf-data", "listsamplesize", "cldf",
+                "cldf-metadata.json").exists()
 
-    
+        datasets = {"allenbai": dict(DATASETS["allenbai"], sha256="0")}
+        with pytest.raises(ValueError):
+            download(datasets, Path(f).joinpath("other"), mirror=Path(f))
+        datasets["allenbai"]["sha256"] = checksum(
+                Path(f).joinpath("allenbai.tar.gz"))
+        download(datasets, Path(f).joinpath("other"), mirror=Path(f))
 
 
 
+
+def test_download_mirror():
+    with tempfile.TemporaryDirectory() as f:
+        source = Path(f).joinpath("source")
+        shutil.copytree(data_path("cldf", "allenbai"), source)
+        repo = Repo.init(source)
+        repo.git.add(all=True)
+        author = Actor("ST2022", "st2022@example.org")
+        repo.index.commit("data", author=author, committer=author)
+        repo.create_tag("v4.0")
+        repo.clone(Path(f).joinpath("mirror", "lexibank", "allenbai.git"),
+                bare=True)
+        download(
+                {"allenbai": DATASETS["allenbai"]},
+                Path(f).joinpath("cldf-data"),
+                jobs=2,
+                mirror=Path(f).joinpath("mirror"))
+        assert Path(f).joinpath(
+                "cldf-data", "allenbai", "cldf", "cldf-metadata.json").exists()
+
+
 def test_prepare():
     with tempfile.TemporaryDirectory() as f:
         prepare(
                 DATASETS,
                 Path(f),
                 data_path("cldf"))
+        assert Path(f).joinpath("manifest.json").exists()
+        assert prepare(DATASETS, Path(f), data_path("cldf")) == []
+        Path(f).joinpath("listsamplesize", "cognates.tsv").unlink()
+        assert prepare(
+                DATASETS, Path(f), data_path("cldf")) == ["listsamplesize"]
+        assert Path(f).joinpath("allenbai", "scorer.json").exists()
+        assert prepare(
+                DATASETS, Path(f), data_path("cldf"), threshold=0.5) == [
+                        "allenbai"]
+
+        # forcing a subset of the datasets keeps the entries of the others
+        assert prepare(
+                {"listsamplesize": DATASETS["listsamplesize"]}, Path(f),
+                data_path("cldf"), force=True) == ["listsamplesize"]
+        with open(Path(f).joinpath("manifest.json")) as g:
+            assert set(json.load(g)) == {"allenbai", "listsamplesize"}
+        assert prepare(
+                DATASETS, Path(f), data_path("cldf"), threshold=0.5) == []
+
+
+def test_get_partial_scorer():
+    wl = Wordlist.from_cldf(
+            data_path("cldf", "allenbai", "cldf", "cldf-metadata.json"),
+            columns=["parameter_id", "concept_name", "language_id", "form",
+                "segments"])
+    part = Partial(wl)
+    get_partial_scorer(part, runs=100, jobs=2)
+    assert hasattr(part, "cscorer")
+    assert part.params["cscorer"]["runs"] == 100
+
+    with tempfile.TemporaryDirectory() as f:
+        assert not get_cached_partial_scorer(
+                Partial(wl), Path(f).joinpath("scorer.json"), runs=100)
+        partB = Partial(wl)
+        assert get_cached_partial_scorer(
+                partB, Path(f).joinpath("scorer.json"), runs=100)
+        assert partB.params["cscorer"]["ratio"] == (2, 1)
+        partB.partial_cluster(method="lexstat", threshold=0.45, ref="cogids")
 
 
 def test_load_cognate_file():
@@ -50,6 +140,16 @@ def test_load_cognate_file():
             data_path("data", "allenbai", "cognates.tsv"))
     assert len(languages) == 9
 
+    languagesB, soundsB, dataB = load_cognate_file(
+            data_path("data", "allenbai", "cognates.tsv"), sounds=False)
+    assert soundsB is None and dataB == data
+
+    languagesC, cognate_sets = iter_cognate_file(
+            data_path("data", "allenbai", "cognates.tsv"))
+    assert languagesC == languages
+    cogid, entries = next(cognate_sets)
+    assert entries == data[cogid]
+
 def test_write_cognate_file():
     with tempfile.TemporaryDirectory() as f:
         out = Path(f).joinpath("dummmy.tsv")
@@ -60,6 +160,33 @@ def test_write_cognate_file():
                 }
         write_cognate_file(languages, data, out)
 
+        write_cognate_file(languages, data, out, binary=True)
+        assert read_cognate_binary(binary_path(out), languages=["b"]) == (
+                ["b"], {"1": {"b": ["b"]}, "2": {"b": ["c"]}})
+        languagesB, sounds, dataB = load_cognate_file(out)
+        assert dataB["2"] == {"a": ["b"], "b": ["c"], "c": []}
+
+        # the binary copy can be read without the text file
+        out.unlink()
+        assert load_cognate_file(out, sounds=False)[2] == dataB
+        PROFILER.enable()
+        try:
+            load_cognate_file(out, sounds=False)
+            assert PROFILER.stats[("", "load")]["bytes"] == binary_path(
+                    out).stat().st_size
+        finally:
+            PROFILER.disable()
+            PROFILER.reset()
+        write_cognate_file(languages, data, out)
+        assert not binary_path(out).exists()
+
+        write_cognate_file(
+                languages,
+                ((str(i), {"a": "x y", "c": ["z"]}) for i in range(3)),
+                out)
+        assert out.read_text().split("\n")[1:3] == [
+                "0\tx y\t\tz", "1\tx y\t\tz"]
+
 
 def test_simple_align():
 
@@ -79,6 +206,88 @@ def test_simple_align():
             )
     assert len(out) == 2
 
+    cache = AlignmentCache(maxsize=1)
+    outA = simple_align(
+            [["b", "k"], ["b", "a", "k"]], ["a", "b"], ["a", "b", "c"],
+            training=False, cache=cache)
+    outB = simple_align(
+            [["b", "a", "k"], ["b", "k"]], ["b", "a"], ["a", "b", "c"],
+            training=False, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert outA == outB
+    simple_align(
+            [["b", "a"], ["b", "a", "k"]], ["a", "b"], ["a", "b", "c"],
+            cache=cache)
+    assert len(cache.alignments) == 1
+
+
+def test_ungap():
+    alignment = [
+            ["t", "-", "x", "t", "-"],
+            ["t", "o", "x", "t", "a"],
+            ["t", "-", "-", "d", "-"]]
+    languages = ["A", "P", "B"]
+    assert ungap(alignment, languages, "P") == [
+            ["t", "x", "t"], ["t.o", "x", "t.a"], ["t", "-", "d"]]
+    assert ungap(alignment, languages, "Q") == alignment
+    assert ungap(
+            [["-", "a"], ["b", "c"]], ["A", "P"], "P") == [
+                    ["-", "a"], ["b", "c"]]
+    items = [
+            (alignment, languages, "P"), (alignment, languages, "A"),
+            ([["a", "b"]], ["P"], "P"), ([["-", "a"], ["b", "c"]], ["A", "P"],
+                "P")]
+    assert ungap_batch(items) == [ungap(*item) for item in items]
+    assert ungap_batch([]) == []
+
+
+def test_correspondence_patterns():
+    patterns = extract_patterns(
+            data_path("data", "listsamplesize", "training-0.50.tsv"))
+    language = patterns.languages[0]
+    target = len(patterns.languages)-1
+    rows = patterns.rows[language]
+    assert len(rows) == len(patterns.cogids[language])
+    matrix, targets, counts = patterns.table(language, exclude=[target])
+    assert matrix.shape[1] == rows.shape[1]-1
+    assert counts.sum() == len(rows)
+    assert len({
+        (tuple(row), sound) for row, sound in zip(
+            matrix.tolist(), targets.tolist())}) == len(matrix)
+    assert tuple(matrix[0]) == tuple(
+            cell for i, cell in enumerate(rows[0]) if i != target)
+
+    # patterns are only aligned once and can be shared by several models
+    bl = Baseline(None, patterns=patterns)
+    bl.fit()
+    assert bl.patterns.rows[language] is rows
+
+    # switching the alignment function keeps the rows of the others
+    unaligned = partial(simple_align, align=False)
+    patterns.align(unaligned)
+    assert patterns.get(simple_align)[0][language] is rows
+    assert patterns.get()[0] is patterns.get(unaligned)[0]
+    assert patterns.table(language, exclude=[target], func=simple_align)[
+            2].tolist() == counts.tolist()
+    other = patterns.rows[language]
+    bl.fit()
+    assert patterns.rows[language] is rows
+    patterns.align(unaligned)
+    assert patterns.rows[language] is other
+    assert len(patterns.aligned) == 2
+    patterns.align(partial(simple_align, align=False))
+    assert len(patterns.aligned) == 2
+
+    # different lambdas are different functions
+    first, second = [
+            (lambda seqs, *args, align=align, **kw: simple_align(
+                seqs, *args, align=align, **kw)) for align in [True, False]]
+    patterns.align(first)
+    patterns.align(second)
+    assert patterns.get(first)[0] is not patterns.get(second)[0]
+    assert patterns.get(first)[0][language].tolist() == rows.tolist()
+    assert patterns.get(second)[0][language].tolist() == other.tolist()
+
 
 def test_baseline():
 
@@ -93,18 +302,112 @@ def test_baseline():
             "Lanping")
     assert out[0] == "Ø"
 
+    items = [
+            (["Eryuan", "Heqing"], ["x e ⁵⁵".split(), "xʰ ẽ ⁵⁵".split()],
+                "Lanping"),
+            (["Eryuan", "Heqing", "Jianchuan"], [
+                "x e ⁵⁵".split(), "xʰ ẽ ⁵⁵".split(), "x ẽ ⁵⁵".split()],
+                "Lanping"),
+            (["Heqing", "Jianchuan"], ["xʰ ẽ ⁵⁵".split(), "x ẽ ⁵⁵".split()],
+                "Eryuan"),
+            ]
+    batch = bl.predict_batch(items)
+    assert batch == [bl.predict(*item) for item in items]
+    assert batch[1] == out
+
+    codes = bl.encode([["x", "-"], ["Ø", "#unknown#"]])
+    assert codes.tolist() == [[bl.sound2idx["x"], 1], [0, 0]]
+    assert bl.decode(codes[0]).tolist() == ["x", "-"]
+
+
+@pytest.mark.skipif(
+        sigtypst2022.shared_memory is None,
+        reason="shared memory requires Python 3.8")
+def test_share_arrays():
+    arrays = [
+            np.arange(6, dtype=np.int16).reshape(3, 2),
+            np.array([1, 2, 3], dtype=np.int32), np.zeros(0, dtype=np.int8)]
+    shm, specs = share_arrays(arrays)
+    try:
+        other, shared = attach_arrays(shm.name, specs)
+        for a, b in zip(arrays, shared):
+            assert a.dtype == b.dtype
+            assert a.tolist() == b.tolist()
+        del shared
+        other.close()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_baseline_parallel(monkeypatch):
+    bl = Baseline(data_path("data", "listsamplesize", "training-0.50.tsv"))
+    bl.fit()
+    blp = Baseline(data_path("data", "listsamplesize", "training-0.50.tsv"))
+    blp.fit(jobs=2)
+    for language in bl.languages:
+        assert bl.patterns.rows[language].tolist() == blp.patterns.rows[
+                language].tolist()
+        assert bl.patterns.cogids[language] == blp.patterns.cogids[language]
+        assert bl.classifiers[language].predictions == blp.classifiers[
+                language].predictions
+
+    # without shared memory, the classifiers are fitted serially
+    monkeypatch.setattr(sigtypst2022, "shared_memory", None)
+    bls = Baseline(None, patterns=blp.patterns)
+    bls.fit(jobs=2)
+    for language in bl.languages:
+        assert bl.classifiers[language].predictions == bls.classifiers[
+                language].predictions
+
+
+def test_fit_classifier():
+
+    class Weighted(object):
+        def fit(self, X, y, sample_weight=None):
+            self.weights = sample_weight
+
+    clf = Weighted()
+    fit_classifier(clf, [[1, 2], [2, 1]], [1, 2], [3, 1])
+    assert clf.weights == [3, 1]
+
+    bl = Baseline(data_path("data", "allenbai", "training-0.20.tsv"))
+    bl.fit()
+    for language in bl.languages:
+        assert len(bl.weights[language]) == len(bl.matrices[language])
+        assert len(set(map(tuple, bl.matrices[language].tolist()))) == len(
+                bl.matrices[language])
+
 
 def test_split_training_test_data():
     languages, sounds, data = load_cognate_file(
             data_path("data", "allenbai", "cognates.tsv"))
     training, test, solutions = split_training_test_data(
             data, languages)
+    assert len(training) == len(data) - int(len(data) * 0.1 + 0.5)
+    assert list(test) == list(solutions)
+    for key, values in solutions.items():
+        language, = values
+        assert test[key][language] == ["?"]
+        assert values[language] == data[key.rsplit("-", 1)[0]][language]
 
 
 def test_split_data():
 
     split_data(DATASETS, data_path("data"))
 
+    with tempfile.TemporaryDirectory() as f:
+        for dataset in DATASETS:
+            Path(f).joinpath(dataset).mkdir()
+            shutil.copy(
+                    data_path("data", dataset, "cognates.tsv"),
+                    Path(f).joinpath(dataset, "cognates.tsv"))
+        split_data(DATASETS, Path(f), props=[0.1, 0.3], jobs=2)
+        for dataset in DATASETS:
+            for name in ["training", "test", "solutions"]:
+                assert Path(f).joinpath(dataset, name+"-0.30.tsv").read_text() \
+                        == data_path("data", dataset, name+"-0.30.tsv").read_text()
+
 
 def test_predict_words():
 
@@ -115,9 +418,215 @@ def test_predict_words():
             )
 
 
+def test_profiler():
+    profiler = Profiler()
+    with profiler.stage("load"):
+        pass
+    assert not profiler.stats
+    with tempfile.TemporaryDirectory() as tmp:
+        profiler.enable(Path(tmp))
+        with profiler.stage("load", items=2, nbytes=10):
+            with profiler.stage("load"):
+                profiler.count("load", items=1)
+        other = Profiler()
+        other.enable()
+        other.label = "test"
+        with other.stage("fit"):
+            pass
+        profiler.merge(other.collect())
+        assert profiler.stats[("", "load")]["calls"] == 1
+        assert profiler.stats[("", "load")]["items"] == 3
+        assert profiler.stats[("test", "fit")]["calls"] == 1
+        profiler.dump()
+        assert Path(tmp, "load.pstats").exists()
+        assert Path(tmp, "profile.json").exists()
+
+        PROFILER.enable()
+        try:
+            predict_words(
+                    data_path("data", "listsamplesize", "training-0.50.tsv"),
+                    data_path("data", "listsamplesize", "test-0.50.tsv"),
+                    Path(tmp, "result-0.50.tsv"))
+            assert {name for label, name in PROFILER.stats} == {
+                    "load", "align", "classifier", "predict"}
+        finally:
+            PROFILER.disable()
+            PROFILER.reset()
+
+
+def test_predict_words_reference():
+    # the output must stay identical to that of the reference baseline
+    with tempfile.TemporaryDirectory() as tmp:
+        predict_words(
+                data_path("data", "allenbai", "training-0.50.tsv"),
+                data_path("data", "allenbai", "test-0.50.tsv"),
+                Path(tmp, "result-0.50.tsv"))
+        with open(Path(tmp, "result-0.50.tsv"), "rb") as f:
+            result = f.read()
+    with open(data_path("data", "allenbai", "expected-0.50.tsv"), "rb") as f:
+        assert result == f.read()
+
+
+def test_predict_words_alignment_cache():
+    cache = AlignmentCache()
+    func = partial(simple_align, cache=cache)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ModelStore(Path(tmp, "models"))
+        predictions = predict_words(
+                data_path("data", "allenbai", "training-0.20.tsv"),
+                data_path("data", "allenbai", "test-0.20.tsv"),
+                Path(tmp, "result-0.20.tsv"), store=store, func=func)
+        assert cache.hits and cache.misses
+        # the alignments are not stored with the model
+        key, = [path.stem for path in Path(tmp, "models").glob("*.pkl")]
+        assert not store.load(key).func.keywords["cache"].alignments
+        assert key == store.key(
+                data_path("data", "allenbai", "training-0.20.tsv"),
+                model="baseline", minrefs=2, threshold=1, func=partial(
+                    simple_align, cache=AlignmentCache()))
+    assert predictions
+
+
+def test_model_store():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        bl = Baseline(data_path("data", "allenbai", "training-0.20.tsv"))
+        bl.fit()
+        return bl
+
+    with tempfile.TemporaryDirectory() as f:
+        store = ModelStore(Path(f))
+        key = store.key(
+                data_path("data", "allenbai", "training-0.20.tsv"),
+                minrefs=2, func=simple_align)
+        assert key != store.key(
+                data_path("data", "allenbai", "training-0.20.tsv"),
+                minrefs=3, func=simple_align)
+        assert key != store.key(
+                data_path("data", "allenbai", "training-0.20.tsv"),
+                minrefs=2, func=partial(simple_align, align=False))
+        # anonymous functions and unstable arguments cannot be keyed
+        for func in [lambda *args: None, factory, partial(
+                simple_align, cache=object())]:
+            with pytest.raises(ValueError):
+                store.key(
+                        data_path("data", "allenbai", "training-0.20.tsv"),
+                        func=func)
+        bl = store.get(key, factory)
+        cached = store.get(key, factory)
+        assert len(calls) == 1
+        args = (["Eryuan", "Heqing"], ["x e ⁵⁵".split(), "xʰ ẽ ⁵⁵".split()],
+                "Lanping")
+        assert cached.predict(*args) == bl.predict(*args)
+
+        store.max_size = 1
+        store.save("other", bl)
+        assert store.load(key) is None
+        assert store.load("other") is not None
+
+
+def test_predict_all():
+    with tempfile.TemporaryDirectory() as f:
+        shutil.copytree(
+                data_path("data", "listsamplesize"),
+                Path(f).joinpath("listsamplesize"))
+        summary = predict_all(
+                {"listsamplesize": DATASETS["listsamplesize"]},
+                Path(f), props=[0.1, 0.2], jobs=2)
+        assert len(summary) == 2
+        assert Path(f).joinpath("listsamplesize", "result-0.20.tsv").exists()
+
+
 def test_compare_words():
     rep = compare_words(
             data_path("data", "allenbai", "results-0.20.tsv"),
             data_path("data", "allenbai", "solutions-0.20.tsv"),
             )
     assert len(rep) == 10
+
+
+def test_evaluate_all():
+    with tempfile.TemporaryDirectory() as tmp:
+        Path(tmp, "allenbai").mkdir()
+        shutil.copy(
+                data_path("data", "allenbai", "results-0.20.tsv"),
+                Path(tmp, "allenbai", "result-0.20.tsv"))
+        table = evaluate_all(
+                {"allenbai": {}, "missing": {}}, data_path("data"),
+                systems=[tmp], props=[0.2, 0.3],
+                output=Path(tmp, "evaluation.json"))
+        with open(Path(tmp, "evaluation.json")) as f:
+            results = json.load(f)
+        assert len(table) == len(results) == 2
+        assert table[0][3:] == compare_words(
+                data_path("data", "allenbai", "results-0.20.tsv"),
+                data_path("data", "allenbai", "solutions-0.20.tsv"),
+                report=False)[-1][1:]
+        assert results[1]["dataset"] == "TOTAL"
+        with pytest.raises(ValueError):
+            evaluate_all(
+                    {"allenbai": {}}, data_path("data"), systems=[tmp],
+                    props=[0.2],
+                    output=Path(tmp, "evaluation.txt"))
+
+
+def test_bcubed():
+    alms = [
+            ["t o x t ə r -".split(), "t o x t - a r".split()],
+            ["a p f e l".split(), "a p f e l".split()],
+            ["m a u s".split(), "h a u s".split()]]
+    bcubed = BCubed()
+    almsA, almsB = [], []
+    for almA, almB in alms:
+        bcubed.update(almA, almB)
+        almsA += almA
+        almsB += almB
+    p, r = bcubed.scores()
+    assert p == pytest.approx(_get_bcubed_score(almsA, almsB))
+    assert r == pytest.approx(_get_bcubed_score(almsB, almsA))
+
+
+def test_evaluate_pairs():
+    pairs = [
+            ["t o x t ə r".split(), "t o x t a".split()],
+            ["a p f e l".split(), "a p f e l".split()],
+            ["k".split(), "k a t s e".split()],
+            ["m a u s".split(), "h a u s".split()]]
+    for (a, b), (almA, almB, score, scoreD, bleu) in zip(
+            pairs, evaluate_pairs(pairs)):
+        assert [almA, almB] == list(nw_align(a, b)[:2])
+        assert score == sum(1 for x, y in zip(almA, almB) if x != y)
+        assert scoreD == score / len(almA)
+        assert bleu == bleu_score(a, b, n=4, trim=False)
+    assert list(evaluate_pairs(pairs, chunksize=1)) == list(
+            evaluate_pairs(pairs))
+    for (a, b), (almA, almB, score) in zip(pairs, nw_align_batch(pairs)):
+        assert score == nw_align(a, b)[2]
+    pairs += [["a".split(), "a a a a a".split()]]
+    assert bleu_scores(pairs) == [
+            bleu_score(a, b, n=4, trim=False) for a, b in pairs]
+    assert bleu_scores([["k a".split(), []]]) == [0.0]
+
+
+def test_benchmark():
+    with tempfile.TemporaryDirectory() as tmp:
+        results = benchmark(
+                {"listsamplesize": DATASETS["listsamplesize"]},
+                data_path("data"), data_path("cldf"), props=[0.5],
+                output=Path(tmp, "old.json"))
+        assert [row["stage"] for row in results["results"]] == [
+                "prepare", "split_data", "fit", "predict", "predict_words",
+                "compare_words"]
+        # prepare is not run a second time to trace its memory
+        assert [row["peak_memory"] is None for row in results[
+            "results"]] == [True, False, False, False, False, False]
+        assert compare_benchmarks(
+                Path(tmp, "old.json"), Path(tmp, "old.json")) == []
+        for row in results["results"]:
+            row["seconds"] *= 2
+        with open(Path(tmp, "new.json"), "w") as f:
+            json.dump(results, f)
+        assert len(compare_benchmarks(
+            Path(tmp, "old.json"), Path(tmp, "new.json"))) == 6